@@ -0,0 +1,166 @@
+# benchmarks/bench_http_pool.py
+"""
+Bot API call latency: telebot's default per-thread sessions vs the shared
+keep-alive pool (utils/http_pool.py), against a local fake Bot API over TLS.
+
+Calls are made the way the webhook server makes them: each "update" runs on a
+fresh thread, several at a time, each doing a few API calls for one of many
+bot tokens. The fake API answers after a fixed delay; every new connection
+also costs one simulated network round trip (--rtt, ms) before the TLS
+handshake, which is where the default setup loses.
+
+Needs the openssl binary for a throwaway certificate.
+    python -m benchmarks.bench_http_pool [updates] [--rtt 20]
+"""
+import json
+import os
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from telebot import TeleBot, apihelper
+
+BOTS = 50
+CALLS_PER_UPDATE = 3
+CONCURRENCY = 8
+API_DELAY = 0.002
+
+
+class _FakeAPI(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    connections = 0
+
+    def setup(self):
+        type(self).connections += 1
+        # headers and body go out as separate writes; don't let Nagle + delayed ACK stall them
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        super().setup()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        time.sleep(API_DELAY)
+        body = json.dumps({"ok": True, "result": {
+            "message_id": 1, "date": 0, "chat": {"id": -1, "type": "supergroup"}, "text": "ok"}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST
+
+    def log_message(self, *args):
+        pass
+
+
+class _TLSServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, context, rtt):
+        super().__init__(("127.0.0.1", 0), _FakeAPI)
+        self.context = context
+        self.rtt = rtt
+
+    def get_request(self):
+        sock, addr = super().get_request()
+        return self.context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False), addr
+
+    def finish_request(self, request, client_address):
+        time.sleep(self.rtt)  # client hello / server hello
+        request.do_handshake()
+        super().finish_request(request, client_address)
+
+
+def _certificate(tmp: str) -> tuple:
+    cert, key = os.path.join(tmp, "cert.pem"), os.path.join(tmp, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1",
+         "-keyout", key, "-out", cert],
+        check=True, capture_output=True,
+    )
+    return cert, key
+
+
+def _run(label: str, bots: list, updates: int) -> dict:
+    _FakeAPI.connections = 0
+    latencies = []
+    lock = threading.Lock()
+    sem = threading.Semaphore(CONCURRENCY)
+
+    def update(i):
+        try:
+            bot = bots[i % len(bots)]
+            for _ in range(CALLS_PER_UPDATE):
+                t = time.perf_counter()
+                bot.send_message(-1, "x")
+                with lock:
+                    latencies.append(time.perf_counter() - t)
+        finally:
+            sem.release()
+
+    start = time.perf_counter()
+    threads = []
+    for i in range(updates):
+        sem.acquire()
+        t = threading.Thread(target=update, args=(i,))  # a new thread per update, like the dev server
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - start
+
+    latencies.sort()
+    n = len(latencies)
+    return {
+        "label": label,
+        "calls": n,
+        "mean_ms": sum(latencies) / n * 1000,
+        "p50_ms": latencies[n // 2] * 1000,
+        "p95_ms": latencies[int(n * 0.95)] * 1000,
+        "connections": _FakeAPI.connections,
+        "calls_per_s": n / wall,
+    }
+
+
+def main(updates: int = 300, rtt_ms: float = 20):
+    with tempfile.TemporaryDirectory() as tmp:
+        cert, key = _certificate(tmp)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        server = _TLSServer(context, rtt_ms / 1000)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        os.environ["REQUESTS_CA_BUNDLE"] = cert
+        apihelper.API_URL = f"https://127.0.0.1:{server.server_port}/bot{{0}}/{{1}}"
+        apihelper.CUSTOM_REQUEST_SENDER = None  # measure the transport only
+        bots = [TeleBot(f"{i}:bench", threaded=False) for i in range(1, BOTS + 1)]
+
+        results = [_run("per-thread sessions (telebot default)", bots, updates)]
+
+        from utils import http_pool
+        http_pool.install()
+        results.append(_run("shared keep-alive pool", bots, updates))
+        server.shutdown()
+
+    print(f"{updates} updates x {CALLS_PER_UPDATE} calls, {BOTS} bots, {CONCURRENCY} concurrent, "
+          f"simulated rtt {rtt_ms:g} ms")
+    print(f"{'':40}{'mean ms':>9}{'p50 ms':>9}{'p95 ms':>9}{'conns':>7}{'calls/s':>9}")
+    for r in results:
+        print(f"{r['label']:40}{r['mean_ms']:>9.1f}{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}"
+              f"{r['connections']:>7}{r['calls_per_s']:>9.0f}")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    rtt = 20.0
+    if "--rtt" in args:
+        i = args.index("--rtt")
+        rtt = float(args[i + 1])
+        del args[i:i + 2]
+    main(int(args[0]) if args else 300, rtt)
@@ -0,0 +1,72 @@
+# benchmarks/bench_session_encoding.py
+"""
+Compare the legacy JSON-dict session entries with the compact v1 tuple
+encoding used by utils.session_store (size per session + encode/decode time).
+
+Run from the repo root (no Redis needed):
+    python -m benchmarks.bench_session_encoding [links]
+"""
+import json
+import random
+import string
+import sys
+import time
+
+from utils.session_store import _encode_entry, _decode_entry
+
+
+def _fake_entries(n: int) -> list:
+    rnd = random.Random(42)
+    entries = []
+    for i in range(1, n + 1):
+        x_username = "".join(rnd.choices(string.ascii_lowercase + "_", k=rnd.randint(5, 14)))
+        first_name = rnd.choice(["Aarav", "Priya", "John", "Maria", "Crypto King 👑", "Neha"])
+        entries.append({
+            "number": i,
+            "user_id": rnd.randint(10**8, 8 * 10**9),
+            "username": rnd.choice([first_name, x_username + "_tg"]),
+            "first_name": first_name,
+            "link": f"https://x.com/{x_username}/status/{rnd.randint(10**18, 2 * 10**18)}?s=20",
+            "x_username": x_username,
+            "check": rnd.random() < 0.5,
+        })
+    return entries
+
+
+def _timeit(fn, repeat: int = 5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main(n: int = 500):
+    entries = _fake_entries(n)
+
+    legacy = [json.dumps(e) for e in entries]  # what _set used to write per entry
+    compact = [_encode_entry(e) for e in entries]
+
+    # the decoded form must be identical (check comes from the checked set)
+    checked = {e["number"] for e in entries if e["check"]}
+    for i, raw in enumerate(compact, start=1):
+        assert _decode_entry(raw, i, checked) == entries[i - 1]
+
+    legacy_bytes = sum(len(s.encode()) for s in legacy)
+    compact_bytes = sum(len(s.encode()) for s in compact)
+
+    t_legacy_enc = _timeit(lambda: [json.dumps(e) for e in entries])
+    t_compact_enc = _timeit(lambda: [_encode_entry(e) for e in entries])
+    t_legacy_dec = _timeit(lambda: [_decode_entry(s, i, checked) for i, s in enumerate(legacy, start=1)])
+    t_compact_dec = _timeit(lambda: [_decode_entry(s, i, checked) for i, s in enumerate(compact, start=1)])
+
+    print(f"{n} links per session")
+    print(f"{'':10}{'bytes':>10}{'encode ms':>12}{'decode ms':>12}")
+    print(f"{'legacy':10}{legacy_bytes:>10}{t_legacy_enc * 1000:>12.2f}{t_legacy_dec * 1000:>12.2f}")
+    print(f"{'v1 tuple':10}{compact_bytes:>10}{t_compact_enc * 1000:>12.2f}{t_compact_dec * 1000:>12.2f}")
+    print(f"size: {compact_bytes / legacy_bytes:.0%} of legacy")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
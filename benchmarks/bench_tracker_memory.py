@@ -0,0 +1,87 @@
+# benchmarks/bench_tracker_memory.py
+"""
+Redis memory of tracked message ids: sorted-set encoding vs chunked bitmaps
+(TRACKER_ENCODING=bitmap), measured with MEMORY USAGE on realistic chats.
+
+Needs a Redis server (REDIS_HOST/REDIS_PORT/REDIS_DB, as the bot). Keys are
+written under the bot id "bench" and deleted afterwards.
+    python -m benchmarks.bench_tracker_memory [chats_per_profile]
+"""
+import random
+import sys
+import time
+
+from config import settings
+from utils.redis_client import get_redis
+from utils import message_tracker as mt, tracker_bitmap
+
+# (name, tracked messages per 48h, share of the chat's message ids the bot sees)
+PROFILES = [
+    ("quiet", 40, 0.7),
+    ("typical", 400, 0.9),
+    ("busy", 3000, 0.95),
+]
+BOT_ID = "bench"
+
+
+def _fake_chat(rnd: random.Random, messages: int, density: float) -> dict:
+    """{message_id: tracked_at} spread over the (still deletable) last ~47h."""
+    now = time.time()
+    mid = rnd.randint(10_000, 2_000_000)
+    ids = {}
+    while len(ids) < messages:
+        mid += 1
+        if rnd.random() < density:
+            ids[mid] = now - (mt.DELETE_WINDOW - 3600) * (1 - len(ids) / messages)
+    return ids
+
+
+def _store(encoding: str, chat_id: int, ids: dict) -> list:
+    object.__setattr__(settings, "TRACKER_ENCODING", encoding)
+    r = get_redis()
+    items = list(ids.items())
+    for i in range(0, len(items), 50):  # roughly what update flushes look like
+        pipe = r.pipeline(transaction=False)
+        mt._write_tracked(pipe, {(BOT_ID, chat_id): (dict(items[i:i + 50]), mt.DEFAULT_TTL)})
+        pipe.execute()
+    if encoding == "bitmap":
+        return tracker_bitmap.bitmap_keys(BOT_ID, chat_id)
+    return [mt._tracked_key(BOT_ID, chat_id)]
+
+
+def _memory(keys: list) -> int:
+    r = get_redis()
+    return sum(r.memory_usage(k, samples=0) or 0 for k in keys)
+
+
+def main(chats: int = 20):
+    rnd = random.Random(42)
+    r = get_redis()
+    print(f"{chats} chats per profile, bytes per chat (MEMORY USAGE)")
+    print(f"{'profile':10}{'ids':>7}{'zset':>10}{'bitmap':>10}{'ratio':>8}")
+    chat_id = -1_000_000
+    total_zset = total_bitmap = 0
+    try:
+        for name, messages, density in PROFILES:
+            zset_bytes = bitmap_bytes = 0
+            for _ in range(chats):
+                chat_id -= 1
+                ids = _fake_chat(rnd, messages, density)
+                zkeys = _store("zset", chat_id, ids)
+                bkeys = _store("bitmap", chat_id, ids)
+                assert mt.count_tracked(chat_id, BOT_ID) == 2 * len(ids)
+                zset_bytes += _memory(zkeys)
+                bitmap_bytes += _memory(bkeys)
+                r.delete(*zkeys, *bkeys)
+            total_zset += zset_bytes
+            total_bitmap += bitmap_bytes
+            print(f"{name:10}{messages:>7}{zset_bytes // chats:>10}{bitmap_bytes // chats:>10}"
+                  f"{bitmap_bytes / zset_bytes:>8.1%}")
+    finally:
+        for key in r.scan_iter(match=f"*:{BOT_ID}:*"):
+            r.delete(key)
+    print(f"all profiles: bitmap is {total_bitmap / total_zset:.1%} of zset")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
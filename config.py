@@ -14,6 +14,44 @@ class Settings:
 
     ADMIN_TELEGRAM_USER_ID: int = int(os.getenv("ADMIN_TELEGRAM_USER_ID", "0"))
     INGRESS_SECRET: str = os.getenv("INGRESS_SECRET", "")
+    # "sync": webhooks run the handlers; "queue": they enqueue to a Redis Stream (utils/ingress.py)
+    INGRESS_MODE: str = os.getenv("INGRESS_MODE", "sync")
+    # consumer threads in the web process (0 = only `python -m utils.ingress` workers consume)
+    INGRESS_CONSUMERS: int = int(os.getenv("INGRESS_CONSUMERS", "2"))
+    # Worker threads updates are sharded over by chat (utils/sharded_dispatch.py); 0 = inline
+    DISPATCH_SHARDS: int = int(os.getenv("DISPATCH_SHARDS", "0"))
+
+    # Write-behind: seconds between flushes of live Redis sessions to MongoDB
+    SESSION_FLUSH_INTERVAL: float = float(os.getenv("SESSION_FLUSH_INTERVAL", "5"))
+
+    # Abandoned sessions: archive + evict after this many idle seconds, checked every sweep interval
+    SESSION_IDLE_TTL: int = int(os.getenv("SESSION_IDLE_TTL", str(48 * 3600)))
+    SESSION_SWEEP_INTERVAL: int = int(os.getenv("SESSION_SWEEP_INTERVAL", "600"))
+
+    # Log Redis round trips + memo hits per dispatched update
+    UPDATE_STATS: bool = os.getenv("UPDATE_STATS", "0") == "1"
+
+    # Background jobs (utils/jobs.py) run at once per process
+    JOB_WORKERS: int = int(os.getenv("JOB_WORKERS", "2"))
+
+    # Tracked message ids: "zset" (id -> timestamp) or "bitmap" (chunked bitmaps, far smaller)
+    TRACKER_ENCODING: str = os.getenv("TRACKER_ENCODING", "zset")
+
+    # Shared (Redis) admin list cache lifetime, seconds
+    ADMIN_CACHE_TTL: int = int(os.getenv("ADMIN_CACHE_TTL", "600"))
+
+    # Outbound Telegram sends (utils/outbound.py): queued + rate limited per chat and per bot
+    OUTBOUND_QUEUE: bool = os.getenv("OUTBOUND_QUEUE", "0") == "1"
+    OUTBOUND_WORKERS: int = int(os.getenv("OUTBOUND_WORKERS", "8"))
+    OUTBOUND_GROUP_PER_MINUTE: int = int(os.getenv("OUTBOUND_GROUP_PER_MINUTE", "20"))
+    OUTBOUND_BOT_PER_SECOND: int = int(os.getenv("OUTBOUND_BOT_PER_SECOND", "30"))
+    # seconds a handler may wait for a queued call (OutboundTimeout); keep well under the webhook timeout
+    OUTBOUND_MAX_WAIT: float = float(os.getenv("OUTBOUND_MAX_WAIT", "10"))
+
+    # Shared keep-alive connection pool for all bots (utils/http_pool.py)
+    HTTP_POOL_SIZE: int = int(os.getenv("HTTP_POOL_SIZE", "32"))
+    HTTP_CONNECT_TIMEOUT: float = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+    HTTP_READ_TIMEOUT: float = float(os.getenv("HTTP_READ_TIMEOUT", "25"))
 
     # Use default_factory for mutable list
     ADMIN_IDS: list[int] = field(
@@ -1,6 +1,7 @@
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 from utils.group_manager import get_allowed_groups
 from utils.message_tracker import track_message
+from utils import outbound
 from config import settings
 
 def handle_manage_groups(bot, bot_id: str, message, db):
@@ -97,8 +98,12 @@ def notify_dev(bot, error, context, message=None):
         f"🧵 <b>Error:</b> <code>{str(error)}</code>"
     )
 
-    try:
-        bot.send_message(dev_id, error_message, parse_mode="HTML")
-    except Exception as e:
-        print(f"[notify_dev failed] {e}")
+    # a flood-limited send shouldn't cost another send
+    flooded = isinstance(error, outbound.OutboundTimeout) or getattr(error, "error_code", None) == 429
+    if not flooded:
+        try:
+            with outbound.priority(outbound.LOW):
+                outbound.detached(lambda: bot.send_message(dev_id, error_message, parse_mode="HTML"))
+        except Exception as e:
+            print(f"[notify_dev failed] {e}")
     print(f"[{context} ERROR] {error}")
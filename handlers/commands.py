@@ -1,7 +1,7 @@
 import handlers.start as start
 import handlers.admin as admin
 from handlers.admin import notify_dev
-from utils.telegram import is_user_admin, set_cached_admins, mute_user, parse_duration
+from utils.telegram import is_user_admin, refresh_admins, parse_duration
 from utils.group_session import (
     handle_add_to_ad_command,
     handle_remove_from_ad_command,
@@ -19,7 +19,8 @@ from utils.group_session import (
     handle_remind_command
 )
 from utils.message_tracker import track_message, delete_tracked_messages
-from utils.message_tracker import delete_tracked_messages_with_progress
+from utils.message_tracker import start_clear_job, clear_job_status
+from utils.mute_job import start_mute_job
 from datetime import timedelta
 from telebot.types import ChatPermissions
 from utils.db import is_command_enabled, get_custom_command
@@ -91,7 +92,8 @@ def handle_command(bot, bot_id: str, message, db):
                     "/rad or /remove_from_ad — Remove a user from the completed list\n"
                     "/d [duration] — Set a deadline (e.g., /d 1h, /d 30m, /d 2d)\n"
                     "/cd — Cancel the current deadline\n"
-                    "/clear or /clean or /delete — Delete all tracked messages from the chat\n"
+                    "/clear or /clean or /delete — Delete all tracked messages from the chat (/clear 2h: only the last 2 hours)\n"
+                    "/clearstatus — Progress of the last /clear\n"
                     "/rule — Display the group rules\n\n"
 
                     "📊 <b>Session & Tracking Tools:</b>\n"
@@ -169,10 +171,9 @@ def handle_group_command(bot, bot_id: str, message, db):
                 notify_dev(bot, e, "/end", message)
 
         elif text == "/refresh_admins":
-            if is_user_admin(bot, chat_id, user_id):
+            if is_user_admin(bot, chat_id, user_id, bot_id=bot_id):
                 try:
-                    admins = bot.get_chat_administrators(chat_id)
-                    set_cached_admins(chat_id, [admin.user.id for admin in admins], bot_id=bot_id)
+                    refresh_admins(bot, chat_id, bot_id=bot_id)
                     msg = bot.send_message(chat_id, "✅ Admin list refreshed.")
                     track_message(chat_id, msg.message_id, bot_id=bot_id)
                 except Exception as e:
@@ -209,7 +210,7 @@ def handle_group_command(bot, bot_id: str, message, db):
 
 
         elif text in ["/verify", "/track", "/check"]:
-            if is_user_admin(bot, chat_id, user_id):
+            if is_user_admin(bot, chat_id, user_id, bot_id=bot_id):
                 try:
                     set_verification_phase(bot_id,chat_id)
                     permissions = ChatPermissions(
@@ -228,7 +229,7 @@ def handle_group_command(bot, bot_id: str, message, db):
                 track_message(chat_id, msg.message_id, bot_id=bot_id)
 
         elif text == "/count":
-            if not is_user_admin(bot, chat_id, user_id):
+            if not is_user_admin(bot, chat_id, user_id, bot_id=bot_id):
                 msg = bot.send_message(chat_id, "❌ Only admins can use this command.")
                 track_message(chat_id, msg.message_id, bot_id=bot_id)
                 return
@@ -240,7 +241,7 @@ def handle_group_command(bot, bot_id: str, message, db):
                 notify_dev(bot, e, "/count", message)
 
         elif text == "/list":
-            if not is_user_admin(bot, chat_id, user_id):
+            if not is_user_admin(bot, chat_id, user_id, bot_id=bot_id):
                 msg = bot.send_message(chat_id, "❌ Only admins can use this command.")
                 track_message(chat_id, msg.message_id, bot_id=bot_id)
                 return
@@ -255,7 +256,7 @@ def handle_group_command(bot, bot_id: str, message, db):
                 notify_dev(bot, e, "/list", message)
 
         elif text == "/unsafe":
-            if not is_user_admin(bot, chat_id, user_id):
+            if not is_user_admin(bot, chat_id, user_id, bot_id=bot_id):
                 msg = bot.send_message(chat_id, "❌ Only admins can use this command.")
                 track_message(chat_id, msg.message_id, bot_id=bot_id)
                 return
@@ -278,7 +279,7 @@ def handle_group_command(bot, bot_id: str, message, db):
                 notify_dev(bot, e, "/unsafe", message)
 
         elif text.startswith("/muteunsafe") or text.startswith("/muteall"):
-            if not is_user_admin(bot, chat_id, user_id):
+            if not is_user_admin(bot, chat_id, user_id, bot_id=bot_id):
                 msg = bot.send_message(chat_id, "❌ Only admins can use this command.")
                 track_message(chat_id, msg.message_id, bot_id=bot_id)
                 return
@@ -301,22 +302,8 @@ def handle_group_command(bot, bot_id: str, message, db):
                     track_message(chat_id, msg.message_id, bot_id=bot_id)
                     return
 
-                success_log, failed = [], []
-                for user in unverified:
-                    uid = user["user_id"]
-                    fname = user.get("first_name", "User")
-                    if mute_user(bot, chat_id, uid, duration):
-                        mention = f'<a href="tg://user?id={uid}">{fname}</a>'
-                        success_log.append(f"• {mention} (ID: <code>{uid}</code>)")
-                    else:
-                        failed.append(fname)
-
-                msg_text = "<b>🔇 Muted the following unSafe users:</b>\n\n" + "\n".join(success_log)
-                if failed:
-                    msg_text += "\n\n⚠️ <b>Failed to mute:</b>\n" + "\n".join(f"• {u}" for u in failed)
-
-                msg = bot.send_message(chat_id, msg_text, parse_mode="HTML")
-                track_message(chat_id, msg.message_id, bot_id=bot_id)
+                # runs in a background job; the progress message is edited as it goes
+                start_mute_job(bot, chat_id, bot_id, unverified, duration)
             except Exception as e:
                 notify_dev(bot, e, "/muteunsafe", message)
 
@@ -371,17 +358,39 @@ def handle_group_command(bot, bot_id: str, message, db):
             except Exception as e:
                 notify_dev(bot, e, "/srlist", message)
 
-        elif text in ["/clear", "/clean","/delete"]:
+        elif text.split()[0] in ["/clear", "/clean","/delete"]:
             try:
 
-                if not is_user_admin(bot, message.chat.id, message.from_user.id):
+                if not is_user_admin(bot, message.chat.id, message.from_user.id, bot_id=bot_id):
                     msg = bot.reply_to(message, "❌ Only admins can use this command.")
                     track_message(message.chat.id, msg.message_id, bot_id=bot_id)
                     return
-                delete_tracked_messages_with_progress(bot, message.chat.id, bot_id=bot_id)
+                # optional age window: "/clear 2h" only deletes the last 2 hours
+                args = text.split(maxsplit=1)
+                max_age = None
+                if len(args) > 1:
+                    window = parse_duration(args[1])
+                    if not window:
+                        msg = bot.reply_to(message, "⚠️ Invalid duration format. Use formats like: /clear 2h, /clear 30m")
+                        track_message(message.chat.id, msg.message_id, bot_id=bot_id)
+                        return
+                    max_age = int(window.total_seconds())
+                # runs in a background job; the progress message is edited as it goes
+                start_clear_job(bot, message.chat.id, bot_id=bot_id, max_age=max_age)
             except Exception as e:
                 notify_dev(bot, e, "/clear", message)
 
+        elif text == "/clearstatus":
+            try:
+                if not is_user_admin(bot, message.chat.id, message.from_user.id, bot_id=bot_id):
+                    msg = bot.reply_to(message, "❌ Only admins can use this command.")
+                    track_message(message.chat.id, msg.message_id, bot_id=bot_id)
+                    return
+                msg = bot.reply_to(message, clear_job_status(message.chat.id, bot_id=bot_id))
+                track_message(message.chat.id, msg.message_id, bot_id=bot_id)
+            except Exception as e:
+                notify_dev(bot, e, "/clearstatus", message)
+
     except Exception as e:
         notify_dev(bot, e, "handle_group_command", message)
 
@@ -1,7 +1,9 @@
 from telebot.types import Message, ChatPermissions
 from utils.telegram import is_user_admin
-from utils.group_session import start_group_session, stop_group_session, get_group_phase
+from utils.group_session import start_group_session, stop_group_session
 from utils.message_tracker import track_message
+from utils.session_archive import archive_session
+from utils import media_registry
 from handlers.admin import notify_dev
 
 
@@ -10,16 +12,13 @@ def handle_start_group(bot, bot_id: str, message: Message):
     user_id = message.from_user.id
 
     try:
-        if is_user_admin(bot, chat_id, user_id):
-            already_started = get_group_phase(bot_id, chat_id)
-            if already_started:
+        if is_user_admin(bot, chat_id, user_id, bot_id=bot_id):
+            # ✅ Start session (atomic: no-op if one is already running)
+            if not start_group_session(bot_id, chat_id):
                 msg = bot.send_message(chat_id, "Group already started!")
                 track_message(chat_id, msg.message_id, bot_id=bot_id)
                 return
 
-            # ✅ Start session
-            start_group_session(bot_id, chat_id)
-
             # ✅ Set group permissions
             try:
                 permissions = ChatPermissions(
@@ -35,7 +34,7 @@ def handle_start_group(bot, bot_id: str, message: Message):
 
             # ✅ Start video
             try:
-                msg = bot.send_video(chat_id, open("gifs/start.mp4", "rb"))
+                msg = media_registry.send_video(bot, chat_id, "start.mp4")
                 track_message(chat_id, msg.message_id, bot_id=bot_id)
             except Exception as e:
                 notify_dev(bot, e, "start_group: send start.mp4", message)
@@ -60,14 +59,10 @@ def handle_cancel_group(bot, bot_id: str, message: Message, db):
     user_id = message.from_user.id
 
     try:
-        if is_user_admin(bot, chat_id, user_id):
+        if is_user_admin(bot, chat_id, user_id, bot_id=bot_id):
             try:
                 data = stop_group_session(bot_id, chat_id)
-                db["LinksData"].update_one(
-                    {"chat_id": chat_id, "bot_id": bot_id},
-                    {"$push": {"data": data}},
-                    upsert=True
-                )
+                archive_session(db, bot_id, chat_id, data)
             except Exception as e:
                 notify_dev(bot, e, "cancel_group: session stop or DB update", message)
 
@@ -86,7 +81,7 @@ def handle_cancel_group(bot, bot_id: str, message: Message, db):
 
             # ✅ Close video
             try:
-                msg = bot.send_video(chat_id, open("gifs/close.mp4", "rb"))
+                msg = media_registry.send_video(bot, chat_id, "close.mp4")
                 track_message(chat_id, msg.message_id, bot_id=bot_id)
             except Exception as e:
                 notify_dev(bot, e, "cancel_group: send close.mp4", message)
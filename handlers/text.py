@@ -11,7 +11,7 @@ from utils.group_session import (
 from utils.message_tracker import track_message
 from utils.telegram import is_user_admin
 from handlers.admin import notify_dev
-from utils import wizard_state, db
+from utils import wizard_state, db, outbound
 
 
 def handle_text(bot, bot_id: str, message: Message, db):
@@ -57,7 +57,7 @@ def handle_group_text(bot, bot_id: str, message: Message, db):
         phase = get_group_phase(bot_id, group_id)
 
         # ignore admins
-        if is_user_admin(bot, chat.id, user.id):
+        if is_user_admin(bot, chat.id, user.id, bot_id=bot_id):
             return
         
         if message and getattr(message, "sender_chat", None):
@@ -93,13 +93,17 @@ def handle_group_text(bot, bot_id: str, message: Message, db):
                 if content in done_keywords or content.startswith("ad"):
                     x_username, status = mark_user_verified(bot_id, group_id, user.id)
                     if x_username:
-                        msg = bot.reply_to(message, f"𝕏 ID @{x_username}")
-                        track_message(chat.id, msg.message_id, bot_id=bot_id)
+                        outbound.detached(
+                            lambda: bot.reply_to(message, f"𝕏 ID @{x_username}"),
+                            lambda message_id: track_message(chat.id, message_id, bot_id=bot_id),
+                        )
                     else:
                         if status is None:
                             return
-                        msg = bot.send_message(chat.id, f"{status}")
-                        track_message(chat.id, msg.message_id, bot_id=bot_id)
+                        outbound.detached(
+                            lambda: bot.send_message(chat.id, f"{status}"),
+                            lambda message_id: track_message(chat.id, message_id, bot_id=bot_id),
+                        )
 
                     if getattr(message, "caption", None):
                         sr_users = get_sr_users(bot_id, group_id)
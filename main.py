@@ -2,8 +2,8 @@ import traceback
 from flask import Flask, request, abort
 from telebot import types
 from config import settings
-from utils.telegram import manager, manual_dispatch
-from utils import db
+from utils.telegram import manager
+from utils import db, sharded_dispatch
 from utils.db import init_db
 from handlers.admin_multi import handle_admin_update
 
@@ -14,9 +14,56 @@ init_db()
 from utils.db import ensure_indexes
 ensure_indexes()
 
+# === Durable sessions: rebuild Redis from MongoDB if it lost its data, then write-behind ===
+from utils.session_persistence import restore_sessions_from_mongo, start_session_flusher
+try:
+    restore_sessions_from_mongo()
+except Exception:
+    traceback.print_exc()
+start_session_flusher()
+
+# === Evict (and archive) sessions abandoned without /end ===
+from utils.session_gc import start_session_sweeper
+start_session_sweeper()
+
+# === Background jobs (/clear, ...) ===
+from utils.jobs import start_job_workers
+start_job_workers()
+
+# === Queued ingress (INGRESS_MODE=queue): webhooks only enqueue, consumers dispatch ===
+from utils import ingress
+if settings.INGRESS_MODE == "queue":
+    ingress.start_webhook_registrar()
+    ingress.start_ingress_consumers()
+
+
+def _check_secret(bot: str):
+    # queue mode only: set_webhook passes INGRESS_SECRET as secret_token and
+    # Telegram echoes it in this header, so it's only required from bots whose
+    # webhook was set with it (webhooks set before that don't send it)
+    if settings.INGRESS_MODE != "queue" or not settings.INGRESS_SECRET:
+        return
+    if not ingress.is_secured(bot):
+        return
+    if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != settings.INGRESS_SECRET:
+        abort(403)
+
+
+def _enqueue(bot: str):
+    try:
+        ingress.enqueue(bot, request.data.decode("utf-8"))
+    except Exception:
+        traceback.print_exc()
+        abort(503)  # Telegram retries
+    return "OK", 200
+
+
 # === Webhook for Admin Bot ===
 @app.route("/webhook/admin", methods=["POST"])
 def webhook_admin():
+    _check_secret(ingress.ADMIN)
+    if settings.INGRESS_MODE == "queue":
+        return _enqueue(ingress.ADMIN)
     try:
         update = types.Update.de_json(request.data.decode("utf-8"))
         if not update:
@@ -36,19 +83,43 @@ def webhook_admin():
 @app.route("/webhook/<string:bot_id>", methods=["POST"])
 def webhook_child(bot_id: str):
     
+    _check_secret(bot_id)
     bot = manager.create_or_get_child(bot_id)
     if not bot:
         abort(404)
+    if settings.INGRESS_MODE == "queue":
+        return _enqueue(bot_id)
     try:
         update = types.Update.de_json(request.data.decode("utf-8"))
         # Child bot already uses its own bot_id
-        manual_dispatch(bot, bot_id, update, db._db)
+        # serial per chat, parallel across chats (DISPATCH_SHARDS)
+        sharded_dispatch.dispatch(bot, bot_id, update, db._db)
     except Exception:
         traceback.print_exc()
         abort(400)
     return "OK", 200
 
 
+# === Outbound send queue (depth per priority, throttling, 429s) for this process ===
+from utils import outbound
+
+@app.get("/metrics/outbound")
+def outbound_metrics():
+    return outbound.metrics(), 200
+
+
+# === Ingress stream (length, unacknowledged, dead-lettered updates) ===
+@app.get("/metrics/ingress")
+def ingress_metrics():
+    return ingress.ingress_stats(), 200
+
+
+# === Sharded dispatch: queued updates per shard ===
+@app.get("/metrics/dispatch")
+def dispatch_metrics():
+    return sharded_dispatch.dispatch_stats(), 200
+
+
 # === Health Check ===
 @app.get("/")
 def health():
@@ -158,6 +158,10 @@ def ensure_indexes():
         unique=True
     )
 
+    # session_archive: one document per finished session
+    from utils.session_archive import ensure_archive_indexes
+    ensure_archive_indexes(db)
+
 # === Custom Commands ===
 def set_bot_custom_command(bot_id: str, command: str, reply: str):
     db = init_db()
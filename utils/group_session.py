@@ -1,219 +1,113 @@
-import json
 from telebot.types import Message, ChatPermissions
 from utils.message_tracker import track_message
 from handlers.admin import notify_dev
 from config import settings
 from utils.telegram import is_user_admin
-from utils.redis_client import get_redis
+from utils import session_store as store, media_registry, outbound
+from utils.update_context import memoized, update_memo, forget, defer_write
 import re
 
 ADMIN_IDS = settings.ADMIN_IDS
 
-# === Redis Connection ===
-r = get_redis()
-
-# Helper: serialize/deserialize dict safely
-def _get(bot_id: str, key: str, default):
-    raw = r.hget(f"sessions:{bot_id}", key)
-    if raw is None:
-        return default
-    return json.loads(raw)
-
-def _set(bot_id: str, key: str, value):
-    r.hset(f"sessions:{bot_id}", key, json.dumps(value))
-
 def normalize_gid(group_id):
     return str(group_id)
 
 # ---------------- Session Control ----------------
-def start_group_session(bot_id: str, group_id):
-    gid = normalize_gid(group_id)
-    active_groups = _get(bot_id, "active_groups", {})
-    group_messages = _get(bot_id, "group_messages", {})
-    sr_requested_users = _get(bot_id, "sr_requested_users", {})
-    unique_x_usernames = _get(bot_id, "unique_x_usernames", {})
-
-    active_groups[gid] = "collecting"
-    group_messages[gid] = []
-    sr_requested_users[gid] = []
-    unique_x_usernames[gid] = []
-
-    _set(bot_id, "active_groups", active_groups)
-    _set(bot_id, "group_messages", group_messages)
-    _set(bot_id, "sr_requested_users", sr_requested_users)
-    _set(bot_id, "unique_x_usernames", unique_x_usernames)
+# reads below are memoized for the current update (utils/update_context.py)
+def _phase_key(bot_id, group_id):
+    return ("phase", bot_id, normalize_gid(group_id))
 
-def stop_group_session(bot_id: str, group_id):
-    gid = normalize_gid(group_id)
-    active_groups = _get(bot_id, "active_groups", {})
-    group_messages = _get(bot_id, "group_messages", {})
-    sr_requested_users = _get(bot_id, "sr_requested_users", {})
-    unique_x_usernames = _get(bot_id, "unique_x_usernames", {})
+def _sr_key(bot_id, group_id):
+    return ("sr", bot_id, normalize_gid(group_id))
 
-    active_groups.pop(gid, None)
-    sr_requested_users.pop(gid, None)
-    unique_x_usernames.pop(gid, None)
-    msgs = group_messages.pop(gid, [])
-
-    _set(bot_id, "active_groups", active_groups)
-    _set(bot_id, "group_messages", group_messages)
-    _set(bot_id, "sr_requested_users", sr_requested_users)
-    _set(bot_id, "unique_x_usernames", unique_x_usernames)
+def start_group_session(bot_id: str, group_id):
+    """Returns False if the group already has a session."""
+    forget(_phase_key(bot_id, group_id), _sr_key(bot_id, group_id))
+    return store.start_session(bot_id, group_id)
 
-    return msgs
+def stop_group_session(bot_id: str, group_id):
+    forget(_phase_key(bot_id, group_id), _sr_key(bot_id, group_id))
+    return store.stop_session(bot_id, group_id)
 
 def set_verification_phase(bot_id: str, group_id):
-    gid = normalize_gid(group_id)
-    active_groups = _get(bot_id, "active_groups", {})
-    if gid in active_groups:
-        active_groups[gid] = "verifying"
-        _set(bot_id, "active_groups", active_groups)
+    forget(_phase_key(bot_id, group_id))
+    store.set_phase(bot_id, group_id, "verifying", only_if_active=True)
 
 def get_group_phase(bot_id: str, group_id):
-    return _get(bot_id, "active_groups", {}).get(normalize_gid(group_id))
+    return memoized(_phase_key(bot_id, group_id), lambda: store.get_phase(bot_id, group_id))
 
 def is_group_verifying(bot_id: str, group_id):
     return get_group_phase(bot_id, group_id) == "verifying"
 
 # ---------------- Messages ----------------
 def add_group_message(bot_id: str, group_id, message_data: dict):
-    gid = normalize_gid(group_id)
-    group_messages = _get(bot_id, "group_messages", {})
-    group_messages.setdefault(gid, []).append(message_data)
-    _set(bot_id, "group_messages", group_messages)
+    store.append_entry(bot_id, group_id, message_data)
 
 def get_group_messages(bot_id: str, group_id):
-    return _get(bot_id, "group_messages", {}).get(normalize_gid(group_id), [])
+    return store.get_entries(bot_id, group_id)
 
 def request_sr(bot_id: str, group_id, user_id):
-    gid = normalize_gid(group_id)
-    sr_users = _get(bot_id, "sr_requested_users", {})
-    group_messages = _get(bot_id, "group_messages", {})
-
-    sr_users.setdefault(gid, [])
-    if user_id not in sr_users[gid]:
-        sr_users[gid].append(user_id)
-
-    for msg in group_messages.get(gid, []):
-        if msg["user_id"] == user_id:
-            msg["check"] = False
-
-    _set(bot_id, "sr_requested_users", sr_users)
-    _set(bot_id, "group_messages", group_messages)
+    store.add_sr_user(bot_id, group_id, user_id)
+    store.set_user_checked(bot_id, group_id, user_id, False)
+    update_memo(_sr_key(bot_id, group_id), lambda users: users | {int(user_id)})
 
 def remove_sr_request(bot_id: str, group_id, user_id):
-    gid = normalize_gid(group_id)
-    sr_users = _get(bot_id, "sr_requested_users", {})
-    if gid in sr_users and user_id in sr_users[gid]:
-        sr_users[gid].remove(user_id)
-        _set(bot_id, "sr_requested_users", sr_users)
+    # nothing reads the result: send it with the update's other deferred writes
+    defer_write(lambda pipe: store.remove_sr_user(bot_id, group_id, user_id, pipe=pipe))
+    update_memo(_sr_key(bot_id, group_id), lambda users: users - {int(user_id)})
 
 def get_sr_users(bot_id: str, group_id):
-    return set(_get(bot_id, "sr_requested_users", {}).get(normalize_gid(group_id), []))
+    return memoized(_sr_key(bot_id, group_id), lambda: store.get_sr_user_ids(bot_id, group_id))
 
 def store_group_message(bot, bot_id: str, message: Message, group_id, user_id, username, text, x_username=None, first_name=None):
-    gid = normalize_gid(group_id)
-    group_messages = _get(bot_id, "group_messages", {})
-    unique_x_usernames = _get(bot_id, "unique_x_usernames", {})
-
-    group_messages.setdefault(gid, [])
-    unique_x_usernames.setdefault(gid, [])
-
     # ✅ Extract all x.com links from the message
     links = re.findall(r"https://x\.com/\S+", text)
 
     if not links:
         return
 
-    # ✅ Count how many links the user already has
-    user_links = [m for m in group_messages[gid] if m["user_id"] == user_id]
+    entries = [{
+        "user_id": user_id,
+        "username": username,
+        "first_name": first_name,
+        "link": link,
+        "x_username": link.split("/")[3],
+    } for link in links]
 
-    # ✅ If user already has 2, block immediately
-    if len(user_links) >= 2:
-        msg = bot.reply_to(message, "⚠️ Maximum two links can be shared.")
-        track_message(message.chat.id, msg.message_id, bot_id=bot_id)
-        return
+    # notices are fire-and-forget; they're tracked once sent
+    tracked = lambda message_id: track_message(message.chat.id, message_id, bot_id=bot_id)
 
-    added = 0
-    for link in links:
-        # stop if adding this would exceed the limit
-        if len(user_links) + added >= 2:
-            msg = bot.reply_to(message, "⚠️ Maximum two links can be shared.")
-            track_message(message.chat.id, msg.message_id, bot_id=bot_id)
-            break
+    # ✅ Two-link limit, duplicate X account check and append run atomically in Redis
+    for verdict in store.ingest_links(bot_id, group_id, user_id, entries, limit=2):
+        if verdict[0] == "limit":
+            outbound.detached(lambda: bot.reply_to(message, "⚠️ Maximum two links can be shared."), tracked)
 
-        x_username = link.split("/")[3]
+        elif verdict[0] == "fraud":
+            _, x_username, offenders = verdict
+            offenders.append((user_id, first_name))
 
-        # First time this X username appears
-        if x_username not in unique_x_usernames[gid]:
-            unique_x_usernames[gid].append(x_username)
-            group_messages[gid].append({
-                "number": len(group_messages[gid]) + 1,
-                "user_id": user_id,
-                "username": username,
-                "first_name": first_name,
-                "link": link,
-                "x_username": x_username,
-                "check": False,
-            })
-            added += 1
-            continue
-
-        # Duplicate username check
-        offenders = [
-            entry for entry in group_messages[gid]
-            if entry["x_username"] == x_username and entry["user_id"] != user_id
-        ]
-        if len(offenders) < 1:
-            group_messages[gid].append({
-                "number": len(group_messages[gid]) + 1,
-                "user_id": user_id,
-                "username": username,
-                "first_name": first_name,
-                "link": link,
-                "x_username": x_username,
-                "check": False,
-            })
-            added += 1
-            continue
-
-        offenders.append({
-            "user_id": user_id,
-            "username": username,
-            "first_name": first_name,
-        })
-
-        tags = []
-        for u in offenders:
-            name = u.get("first_name") or "User"
-            uid = u.get("user_id")
-            if uid:
-                tags.append(f'<a href="tg://user?id={uid}">{name}</a>')
-        tags_str = ", ".join(sorted(set(tags)))
-
-        alert = (
-            f"⚠️ <b>Fraud Alert</b>\n"
-            f"Multiple users are sharing the same X account link: <code>{x_username}</code>\n"
-            f"Suspicious users: {tags_str}"
-        )
-        msg = bot.reply_to(message, text=alert, parse_mode="HTML")
-        track_message(message.chat.id, msg.message_id, bot_id=bot_id)
+            tags = []
+            for uid, name in offenders:
+                if uid:
+                    tags.append(f'<a href="tg://user?id={uid}">{name or "User"}</a>')
+            tags_str = ", ".join(sorted(set(tags)))
+
+            alert = (
+                f"⚠️ <b>Fraud Alert</b>\n"
+                f"Multiple users are sharing the same X account link: <code>{x_username}</code>\n"
+                f"Suspicious users: {tags_str}"
+            )
+            outbound.detached(lambda: bot.reply_to(message, text=alert, parse_mode="HTML"), tracked)
 
-    # ✅ Save updated session
-    _set(bot_id, "group_messages", group_messages)
-    _set(bot_id, "unique_x_usernames", unique_x_usernames)
 # ---------------- Group closing & verification ----------------
 def handle_close_group(bot, bot_id: str, message):
 
-    if not is_user_admin(bot, message.chat.id, message.from_user.id):
+    if not is_user_admin(bot, message.chat.id, message.from_user.id, bot_id=bot_id):
         msg = bot.reply_to(message, "❌ Only admins can use this command.")
         track_message(message.chat.id, msg.message_id, bot_id=bot_id)
         return
     
-    gid = normalize_gid(message.chat.id)
-    active_groups = _get(bot_id, "active_groups", {})
-    active_groups[gid] = "closed"
-    _set(bot_id, "active_groups", active_groups)
+    store.set_phase(bot_id, message.chat.id, "closed")
 
     try:
         restricted_permissions = ChatPermissions(
@@ -228,7 +122,7 @@ def handle_close_group(bot, bot_id: str, message):
         pass
 
     try:
-        msg = bot.send_video(message.chat.id, open("gifs/stop.mp4", "rb"))
+        msg = media_registry.send_video(bot, message.chat.id, "stop.mp4")
         msg2 = bot.send_message(message.chat.id, "Time line is getting updated wait few mins.")
         track_message(message.chat.id, msg2.message_id, bot_id=bot_id)
         track_message(message.chat.id, msg.message_id, bot_id=bot_id)
@@ -237,38 +131,23 @@ def handle_close_group(bot, bot_id: str, message):
 
 
 def mark_user_verified(bot_id: str, group_id, user_id):
-    gid = normalize_gid(group_id)
-    group_messages = _get(bot_id, "group_messages", {})
-    x_usernames = set()
-    found_any = False
-
-    if gid not in group_messages:
+    if get_group_phase(bot_id, group_id) is None:
         return None, "no_group"
 
-    for msg in group_messages[gid]:
-        if msg["user_id"] == user_id:
-            found_any = True
-            if not msg["check"]:
-                msg["check"] = True
-                x_usernames.add(msg["x_username"])
-
-    _set(bot_id, "group_messages", group_messages)
+    found_any, newly_checked = store.set_user_checked(bot_id, group_id, user_id, True)
 
     if not found_any:
         return None, None
-    elif not x_usernames:
+    elif not newly_checked:
         return None, "𝕏 already verified"
     else:
-        return list(x_usernames)[0], "verified"
+        return store.get_entry(bot_id, group_id, newly_checked[0])["x_username"], "verified"
 
 
 def get_users_with_multiple_links(bot_id: str, group_id):
     from collections import defaultdict
-    gid = normalize_gid(group_id)
-    group_messages = _get(bot_id, "group_messages", {})
-
     user_links = defaultdict(list)
-    for msg in group_messages.get(gid, []):
+    for msg in get_group_messages(bot_id, group_id):
         user_links[msg["user_id"]].append(msg)
 
     result = []
@@ -285,11 +164,8 @@ def get_users_with_multiple_links(bot_id: str, group_id):
 
 def get_formatted_user_link_list(bot_id: str, group_id):
     from collections import defaultdict
-    gid = normalize_gid(group_id)
-    group_messages = _get(bot_id, "group_messages", {})
-
     grouped = defaultdict(lambda: {"x_username": None, "first_name": None, "links": []})
-    for msg in group_messages.get(gid, []):
+    for msg in get_group_messages(bot_id, group_id):
         uid = msg["user_id"]
         grouped[uid]["x_username"] = msg["x_username"]
         grouped[uid]["first_name"] = msg.get("first_name", "User")
@@ -309,16 +185,14 @@ def get_formatted_user_link_list(bot_id: str, group_id):
 
 
 def get_unverified_users(bot_id: str, group_id):
-    gid = normalize_gid(group_id)
-    group_messages = _get(bot_id, "group_messages", {})
     seen = set()
     unverified_users = []
 
-    phase = get_group_phase(bot_id, gid)
+    phase = get_group_phase(bot_id, group_id)
     if phase != "verifying":
         return 'notVerifyingphase'
 
-    for msg in group_messages.get(gid, []):
+    for msg in get_group_messages(bot_id, group_id):
         user_id = msg["user_id"]
         number = msg["number"]
         if not msg["check"] and user_id not in seen:
@@ -329,23 +203,18 @@ def get_unverified_users(bot_id: str, group_id):
 
 
 def get_all_links_count(bot_id: str, group_id):
-    gid = normalize_gid(group_id)
-    group_messages = _get(bot_id, "group_messages", {})
-    unique_users = set(msg["user_id"] for msg in group_messages.get(gid, []))
-    return len(unique_users)
+    return store.get_session_stats(bot_id, group_id)["users"]
 
 
 def get_unverified_users_full(bot_id: str, group_id):
-    gid = normalize_gid(group_id)
-    group_messages = _get(bot_id, "group_messages", {})
     seen = set()
     users = []
 
-    phase = get_group_phase(bot_id, gid)
+    phase = get_group_phase(bot_id, group_id)
     if phase != "verifying":
         return 'notVerifyingphase'
 
-    for msg in group_messages.get(gid, []):
+    for msg in get_group_messages(bot_id, group_id):
         uid = msg["user_id"]
         if not msg["check"] and uid not in seen:
             seen.add(uid)
@@ -361,7 +230,7 @@ def handle_add_to_ad_command(bot, bot_id: str, message):
     try:
         chat_id = normalize_gid(message.chat.id)
 
-        if not is_user_admin(bot, chat_id, message.from_user.id):
+        if not is_user_admin(bot, chat_id, message.from_user.id, bot_id=bot_id):
             msg = bot.reply_to(message, "❌ Only admins can use this command.")
             track_message(chat_id, msg.message_id, bot_id=bot_id)
             return
@@ -375,11 +244,7 @@ def handle_add_to_ad_command(bot, bot_id: str, message):
         user_id = reply_to_message.from_user.id
         display_name = f'<a href="tg://user?id={user_id}">{reply_to_message.from_user.first_name}</a>'
 
-        group_messages = _get(bot_id, "group_messages", {})
-        for entry in group_messages.get(chat_id, []):
-            if entry["user_id"] == user_id:
-                entry["check"] = True
-        _set(bot_id, "group_messages", group_messages)
+        store.set_user_checked(bot_id, chat_id, user_id, True)
 
         msg = bot.reply_to(message, f"{display_name} has been marked as AD.", parse_mode="HTML")
         track_message(chat_id, msg.message_id, bot_id=bot_id)
@@ -396,7 +261,7 @@ def handle_remove_from_ad_command(bot, bot_id: str, message):
     try:
         chat_id = normalize_gid(message.chat.id)
 
-        if not is_user_admin(bot, chat_id, message.from_user.id):
+        if not is_user_admin(bot, chat_id, message.from_user.id, bot_id=bot_id):
             msg = bot.reply_to(message, "❌ Only admins can use this command.")
             track_message(chat_id, msg.message_id, bot_id=bot_id)
             return
@@ -410,11 +275,7 @@ def handle_remove_from_ad_command(bot, bot_id: str, message):
         user_id = reply_to_message.from_user.id
         display_name = f'<a href="tg://user?id={user_id}">{reply_to_message.from_user.first_name}</a>'
 
-        group_messages = _get(bot_id, "group_messages", {})
-        for entry in group_messages.get(chat_id, []):
-            if entry["user_id"] == user_id:
-                entry["check"] = False
-        _set(bot_id, "group_messages", group_messages)
+        store.set_user_checked(bot_id, chat_id, user_id, False)
 
         msg = bot.reply_to(message, f"{display_name} has been marked as Not AD.", parse_mode="HTML")
         track_message(chat_id, msg.message_id, bot_id=bot_id)
@@ -468,34 +329,17 @@ def handle_summary_command(bot, bot_id, message):
         chat_id = message.chat.id
         group_id = chat_id
 
-        # Get stored messages + SR requests
-        group_messages = get_group_messages(bot_id, group_id)
-        sr_users = get_sr_users(bot_id, group_id)
-
-        total_links = len(group_messages)
-
-        # Count unique users
-        all_users = {msg["user_id"] for msg in group_messages}
-        total_users = len(all_users)
-
-        # ✅ Verified users (any entry.check == True)
-        verified_users = {msg["user_id"] for msg in group_messages if msg.get("check")}
-        verified_users_set = set(verified_users)
-
-        verified_count = len(verified_users_set)
-
-        # ❌ Not verified users = all - verified
-        not_verified_users = all_users - verified_users
-        not_verified_count = len(not_verified_users)
+        # Counters are maintained on every write (users with any checked entry count as verified)
+        stats = store.get_session_stats(bot_id, group_id)
 
         # === Build summary ===
         summary = (
             "📊 <b>Session Summary</b>\n\n"
-            f"👥 Total users: <b>{total_users}</b>\n"
-            f"🔗 Total links: <b>{total_links}</b>\n\n"
-            f"📹 SR requested: <b>{len(sr_users)}</b>\n\n"
-            f"✅ Verified users: <b>{verified_count}</b>\n"
-            f"❌ Unsafe users: <b>{not_verified_count}</b>\n\n"
+            f"👥 Total users: <b>{stats['users']}</b>\n"
+            f"🔗 Total links: <b>{stats['links']}</b>\n\n"
+            f"📹 SR requested: <b>{stats['sr']}</b>\n\n"
+            f"✅ Verified users: <b>{stats['verified']}</b>\n"
+            f"❌ Unsafe users: <b>{stats['unsafe']}</b>\n\n"
         )
 
         msg = bot.send_message(chat_id, summary, parse_mode="HTML")
@@ -511,7 +355,7 @@ def handle_link_command(bot, bot_id: str, message: Message):
         chat_id = normalize_gid(message.chat.id)
         from_id = message.from_user.id
 
-        if not is_user_admin(bot, chat_id, from_id):
+        if not is_user_admin(bot, chat_id, from_id, bot_id=bot_id):
             msg = bot.reply_to(message, "❌ Only admins can use this command.")
             track_message(chat_id, msg.message_id, bot_id=bot_id)
             return False
@@ -525,11 +369,7 @@ def handle_link_command(bot, bot_id: str, message: Message):
         user_id = target_user.id
         display_name = f'<a href="tg://user?id={user_id}">{target_user.first_name}</a>'
 
-        links = [
-            entry["link"]
-            for entry in _get(bot_id, "group_messages", {}).get(chat_id, [])
-            if entry["user_id"] == user_id
-        ]
+        links = [entry["link"] for entry in store.get_user_entries(bot_id, chat_id, user_id)]
 
         if not links:
             msg = bot.reply_to(message, f"❌ No links found for {display_name}.", parse_mode="HTML")
@@ -548,7 +388,7 @@ def handle_sr_command(bot, bot_id: str, message: Message):
     try:
         chat_id = normalize_gid(message.chat.id)
 
-        if not is_user_admin(bot, chat_id, message.from_user.id):
+        if not is_user_admin(bot, chat_id, message.from_user.id, bot_id=bot_id):
             msg = bot.reply_to(message, "❌ Only admins can use this command.")
             track_message(chat_id, msg.message_id, bot_id=bot_id)
             return
@@ -573,7 +413,7 @@ def handle_srlist_command(bot, bot_id: str, message: Message):
     try:
         chat_id = normalize_gid(message.chat.id)
 
-        if not is_user_admin(bot, chat_id, message.from_user.id):
+        if not is_user_admin(bot, chat_id, message.from_user.id, bot_id=bot_id):
             msg = bot.reply_to(message, "❌ Only admins can use this command.")
             track_message(chat_id, msg.message_id, bot_id=bot_id)
             return
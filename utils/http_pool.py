@@ -0,0 +1,45 @@
+# utils/http_pool.py
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from telebot import apihelper
+from config import settings
+
+# One keep-alive requests.Session for every TeleBot in the process.
+#
+# telebot otherwise keeps a Session per thread and drops it every 10 minutes,
+# and the webhook server runs each update on a new thread, so most Bot API
+# calls paid for a TCP + TLS handshake. All bots talk to the same host, so a
+# single bounded pool (HTTP_POOL_SIZE connections, callers wait for a free
+# one) serves the admin bot and every child bot.
+
+_session = None
+
+
+def build_session() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=4,                # hosts: api.telegram.org (+ a custom API_URL)
+        pool_maxsize=settings.HTTP_POOL_SIZE,
+        pool_block=True,
+        # only retry failures before the request was sent: a resent sendMessage would post twice
+        max_retries=Retry(total=2, connect=2, read=0, status=0, redirect=0, backoff_factor=0.2),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    global _session
+    if _session is None:
+        _session = build_session()
+    return _session
+
+
+def install():
+    """Make telebot use the shared session and the configured timeouts."""
+    apihelper.session = get_session()
+    apihelper.SESSION_TIME_TO_LIVE = None  # keep it; idle connections are re-checked by urllib3
+    apihelper.CONNECT_TIMEOUT = settings.HTTP_CONNECT_TIMEOUT
+    apihelper.READ_TIMEOUT = settings.HTTP_READ_TIMEOUT
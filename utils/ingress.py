@@ -0,0 +1,429 @@
+# utils/ingress.py
+import hashlib
+import json
+import os
+import socket
+import sys
+import time
+import traceback
+from collections import deque
+from queue import Full
+from threading import Thread, Event
+from telebot import types
+from config import settings
+from utils.redis_client import get_redis
+from utils import sharded_dispatch
+from utils.jobs import scheduler
+
+_r = get_redis()
+
+# INGRESS_MODE=queue: webhooks only check the secret header and append the
+# raw update to a Redis Stream; consumers run the handlers.
+#
+# The header is only there once a webhook was registered with INGRESS_SECRET
+# as secret_token, so the secret is enforced per bot, and only once that bot's
+# webhook was set with it (mark_secured). register_webhooks re-registers the
+# admin and enabled child webhooks that aren't marked yet; it runs at startup
+# and then every REGISTER_EVERY seconds until all of them carry the secret.
+#
+#   ingress:updates                  stream  bot (child bot id or ADMIN), update (raw JSON)
+#   ingress:updates / group dispatch consumers: "{host}-{pid}-{n}"
+#   ingress_seen:{bot}:{update_id}   str     set on enqueue; Telegram re-deliveries are dropped
+#   ingress:dead                     stream  updates that failed MAX_DELIVERIES times
+#   ingress:webhook_secured          hash    bot -> sha256 of the secret its webhook was set with
+#   ingress:sharded_reader           str     consumer holding the sharded reader lease
+#
+# An entry is acknowledged (XACK) once its handler returned. If the consumer
+# dies or the handler raises, the entry stays pending and any consumer takes
+# it over with XCLAIM after CLAIM_IDLE_MS (found through XPENDING, so entries
+# this process still holds are left alone).
+#
+# Consumers run as threads of the web process (INGRESS_CONSUMERS) and/or as
+# separate processes:
+#     python -m utils.ingress [threads]
+#
+# With DISPATCH_SHARDS > 0 a single reader hands entries to the chat's shard
+# (utils/sharded_dispatch.py) and acks them when the shard is done, so each
+# chat is handled in stream order while chats run in parallel. Only the
+# consumer holding the ingress:sharded_reader lease (READER_LEASE_MS, renewed
+# every HEARTBEAT_EVERY) reads or reclaims, so that holds across processes;
+# the others stand by and take over once the lease lapses. Every
+# HEARTBEAT_EVERY a process also re-claims its in-flight entries for itself
+# (XCLAIM ... JUSTID), which keeps them from looking idle to the next reader
+# while a shard or the backlog still holds them. The shard retries a failing update SHARD_ATTEMPTS
+# times, then dead-letters it and moves on, rather than leaving it for a
+# reclaim that would replay it behind later updates of its chat. A full shard
+# doesn't stop the reader: its entries wait in a per-shard backlog, in order,
+# and reading pauses only once BACKLOG_MAX entries are waiting overall.
+
+STREAM_KEY = "ingress:updates"
+DEAD_KEY = "ingress:dead"
+SECURED_KEY = "ingress:webhook_secured"
+GROUP = "dispatch"
+ADMIN = "admin"
+
+MAXLEN = 100_000
+SEEN_TTL = 3600
+BATCH = 10
+BLOCK_MS = 2000
+CLAIM_IDLE_MS = 60_000
+CLAIM_EVERY = 30  # seconds between reclaim passes per consumer
+MAX_DELIVERIES = 5
+SHARD_ATTEMPTS = 3
+BACKLOG_MAX = 1000
+REGISTER_EVERY = 300  # seconds between passes over webhooks still without the secret
+READER_KEY = "ingress:sharded_reader"
+READER_LEASE_MS = 30_000
+HEARTBEAT_EVERY = 10  # seconds; well under READER_LEASE_MS and CLAIM_IDLE_MS
+
+# KEYS: stream, seen   ARGV: maxlen, seen ttl, then field/value pairs
+_ENQUEUE_LUA = """
+if not redis.call('SET', KEYS[2], 1, 'NX', 'EX', ARGV[2]) then return false end
+return redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], '*', unpack(ARGV, 3))
+"""
+_enqueue_script = _r.register_script(_ENQUEUE_LUA)
+
+# KEYS: reader lease   ARGV: consumer, lease ms -- take the lease if free, or renew our own
+_LEASE_LUA = """
+local holder = redis.call('GET', KEYS[1])
+if holder and holder ~= ARGV[1] then return 0 end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return 1
+"""
+_lease_script = _r.register_script(_LEASE_LUA)
+
+_stop = Event()
+_threads = []
+_inflight = set()  # entry ids handed to a shard (or its backlog) and not acked yet
+_backlog = {}  # shard index -> deque of entries waiting for room on that shard
+_secured = set()  # bots seen marked for the current secret (a mark is never taken back while it holds)
+
+
+def enqueue(bot: str, raw: str):
+    """Queue a raw update for `bot` (child bot id or ADMIN). Returns the entry id, or None for a duplicate."""
+    update_id = json.loads(raw).get("update_id")
+    return _enqueue_script(
+        keys=[STREAM_KEY, f"ingress_seen:{bot}:{update_id}"],
+        args=[MAXLEN, SEEN_TTL, "bot", bot, "update", raw],
+    )
+
+
+def ensure_group():
+    try:
+        _r.xgroup_create(STREAM_KEY, GROUP, id="0", mkstream=True)
+    except Exception as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def _digest() -> str:
+    return hashlib.sha256(settings.INGRESS_SECRET.encode()).hexdigest()
+
+
+def mark_secured(bot: str):
+    """Record that `bot`'s webhook (child bot id or ADMIN) was just set with INGRESS_SECRET."""
+    if settings.INGRESS_SECRET:
+        _r.hset(SECURED_KEY, bot, _digest())
+
+
+def unmark_secured(bot: str):
+    _r.hdel(SECURED_KEY, bot)
+    _secured.discard(bot)
+
+
+def is_secured(bot: str) -> bool:
+    """True once `bot`'s webhook carries the current INGRESS_SECRET, so its requests must too."""
+    if bot in _secured:
+        return True
+    if not settings.INGRESS_SECRET or _r.hget(SECURED_KEY, bot) != _digest():
+        return False
+    _secured.add(bot)
+    return True
+
+
+def register_webhooks() -> bool:
+    """
+    Set the admin and every enabled child webhook not yet marked secured again
+    with INGRESS_SECRET as secret_token. True when all of them carry it.
+    """
+    from utils.telegram import manager, ALLOWED_UPDATES  # utils.telegram imports the handlers
+    from utils import db
+
+    if not settings.INGRESS_SECRET:
+        return False
+    digest = _digest()
+    if not _r.set(f"{SECURED_KEY}:lock", os.getpid(), nx=True, ex=120):
+        return False  # another worker is at it
+    ok = True
+    try:
+        secured = _r.hgetall(SECURED_KEY)
+        if settings.BASE_URL and secured.get(ADMIN) != digest:
+            try:
+                # allowed_updates left out: Telegram keeps the admin webhook's current list
+                manager.admin_bot.set_webhook(f"{settings.BASE_URL.rstrip('/')}/webhook/admin",
+                                              secret_token=settings.INGRESS_SECRET)
+                mark_secured(ADMIN)
+            except Exception as e:
+                ok = False
+                print(f"[ingress.register_webhooks] admin: {e}")
+        for doc in db.list_bots():
+            if doc.get("status") != "enabled" or not doc.get("webhook_url"):
+                continue
+            bot_id = str(doc["_id"])
+            if secured.get(bot_id) == digest:
+                continue
+            try:
+                manager.create_or_get_child(bot_id).set_webhook(
+                    doc["webhook_url"], allowed_updates=ALLOWED_UPDATES, secret_token=settings.INGRESS_SECRET)
+                mark_secured(bot_id)
+            except Exception as e:
+                ok = False
+                print(f"[ingress.register_webhooks] {bot_id}: {e}")
+    except Exception as e:
+        ok = False
+        print(f"[ingress.register_webhooks] {e}")
+    finally:
+        _r.delete(f"{SECURED_KEY}:lock")
+    return ok
+
+
+def _register_job():
+    if register_webhooks():
+        scheduler.remove_job("ingress_register")
+
+
+def start_webhook_registrar(interval: int = None):
+    """Register the webhooks now, then retry the ones left over on the job scheduler (idempotent)."""
+    if scheduler.get_job("ingress_register") or register_webhooks():
+        return scheduler
+    scheduler.add_job(
+        _register_job,
+        "interval",
+        seconds=interval or REGISTER_EVERY,
+        id="ingress_register",
+        max_instances=1,
+        coalesce=True,
+    )
+    if not scheduler.running:
+        scheduler.start()
+    return scheduler
+
+
+def process_update(bot: str, raw: str):
+    """Run the same handlers the synchronous webhooks run."""
+    from utils.telegram import manager, manual_dispatch  # utils.telegram imports the handlers
+    from handlers.admin_multi import handle_admin_update
+    from utils import db
+
+    update = types.Update.de_json(raw) if isinstance(raw, str) else raw
+    if not update:
+        return
+    if bot == ADMIN:
+        handle_admin_update(update)
+        return
+    child = manager.create_or_get_child(bot)
+    if child is None:
+        print(f"[ingress] dropping update for unknown/disabled bot {bot}")
+        return
+    manual_dispatch(child, bot, update, db._db)
+
+
+def _handle(entry_id: str, fields: dict, handler=None) -> bool:
+    """Process one entry and XACK it. False if it failed and stays pending."""
+    try:
+        (handler or process_update)(fields.get("bot"), fields.get("update"))
+    except Exception:
+        traceback.print_exc()
+        return False
+    _r.xack(STREAM_KEY, GROUP, entry_id)
+    return True
+
+
+def _dead_letter(entry_id: str, fields: dict, why: str):
+    pipe = _r.pipeline()
+    pipe.xadd(DEAD_KEY, {**fields, "id": entry_id}, maxlen=10_000, approximate=True)
+    pipe.xack(STREAM_KEY, GROUP, entry_id)
+    pipe.execute()
+    print(f"[ingress] {entry_id} {why}, moved to {DEAD_KEY}")
+
+
+def _process_in_shard(bot: str, update):
+    """process_update, retried in place so the chat's later updates keep waiting behind it."""
+    for attempt in range(1, SHARD_ATTEMPTS + 1):
+        try:
+            return process_update(bot, update)
+        except Exception:
+            if attempt == SHARD_ATTEMPTS:
+                raise
+            traceback.print_exc()
+            time.sleep(0.5 * attempt)
+
+
+def _done_in_shard(entry_id: str, fields: dict, future):
+    error = future.exception()
+    try:
+        if error:
+            traceback.print_exception(type(error), error, error.__traceback__)
+            _dead_letter(entry_id, fields, f"failed {SHARD_ATTEMPTS} times")
+        else:
+            _r.xack(STREAM_KEY, GROUP, entry_id)
+    except Exception as e:
+        print(f"[ingress.ack] {entry_id}: {e}")  # stays pending; reclaimed and handled again
+    finally:
+        _inflight.discard(entry_id)
+
+
+def _try_submit(entry) -> bool:
+    """Queue the entry on its shard without blocking. False if the shard is full."""
+    entry_id, fields, key, update = entry
+    try:
+        future = sharded_dispatch.get_dispatcher().submit(
+            key, _process_in_shard, fields.get("bot"), update, block=False)
+    except Full:
+        return False
+    future.add_done_callback(lambda f: _done_in_shard(entry_id, fields, f))
+    return True
+
+
+def _submit(entry_id: str, fields: dict):
+    """Hand the entry to its chat's shard, behind that shard's backlog; it's acked when the shard is done."""
+    try:
+        update = types.Update.de_json(fields.get("update"))
+    except Exception as e:
+        _dead_letter(entry_id, fields, f"unreadable ({e!r})")
+        return
+    if not update:
+        _r.xack(STREAM_KEY, GROUP, entry_id)
+        return
+    key = sharded_dispatch.shard_key(fields.get("bot"), update)
+    shard = sharded_dispatch.get_dispatcher().shard_for(key)
+    entry = (entry_id, fields, key, update)
+    _inflight.add(entry_id)
+    if shard in _backlog or not _try_submit(entry):
+        _backlog.setdefault(shard, deque()).append(entry)
+
+
+def _drain_backlog() -> int:
+    """Move waiting entries onto shards with room again. Returns how many still wait."""
+    for shard, waiting in list(_backlog.items()):
+        while waiting and _try_submit(waiting[0]):
+            waiting.popleft()
+        if not waiting:
+            del _backlog[shard]
+    return sum(len(waiting) for waiting in _backlog.values())
+
+
+def _claim_stale(consumer: str, handler=None) -> int:
+    """Take over entries other consumers left pending; dead-letter the hopeless ones."""
+    pending = _r.xpending_range(STREAM_KEY, GROUP, min="-", max="+", count=BATCH * 10, idle=CLAIM_IDLE_MS)
+    # ours and still queued on a shard: not lost, and claiming would count a delivery
+    stale = [p for p in pending if p["message_id"] not in _inflight][:BATCH]
+    if not stale:
+        return 0
+    delivered = {p["message_id"]: p["times_delivered"] for p in stale}
+    entries = _r.xclaim(STREAM_KEY, GROUP, consumer, CLAIM_IDLE_MS, list(delivered))
+    for entry_id, fields in entries:
+        if not fields:  # trimmed away while pending
+            _r.xack(STREAM_KEY, GROUP, entry_id)
+            continue
+        if delivered.get(entry_id, 0) >= MAX_DELIVERIES:
+            _dead_letter(entry_id, fields, f"failed {MAX_DELIVERIES} times")
+            continue
+        _process(entry_id, fields, handler)
+    return len(entries)
+
+
+def _heartbeat(consumer: str) -> bool:
+    """Reset the idle time of our in-flight entries and take or renew the reader lease. True if we hold it."""
+    inflight = list(_inflight)
+    for i in range(0, len(inflight), 100):
+        # min idle 0 and JUSTID: the idle clock restarts, the delivery count doesn't move
+        _r.xclaim(STREAM_KEY, GROUP, consumer, 0, inflight[i:i + 100], justid=True)
+    return bool(_lease_script(keys=[READER_KEY], args=[consumer, READER_LEASE_MS]))
+
+
+def _process(entry_id: str, fields: dict, handler=None):
+    if handler is None and sharded_dispatch.get_dispatcher():
+        _submit(entry_id, fields)
+    else:
+        _handle(entry_id, fields, handler)
+
+
+def run_consumer(consumer: str, stop: Event = None, handler=None):
+    """Read, dispatch and acknowledge entries until `stop` is set."""
+    stop = stop or _stop
+    ensure_group()
+    sharded = handler is None and sharded_dispatch.get_dispatcher() is not None
+    next_claim = next_heartbeat = 0
+    reader = not sharded
+    while not stop.is_set():
+        try:
+            if sharded and time.time() >= next_heartbeat:
+                next_heartbeat = time.time() + HEARTBEAT_EVERY
+                reader = _heartbeat(consumer)
+            if not reader:
+                _drain_backlog()  # finish what we read while we held the lease
+                stop.wait(1)  # another process is the sharded reader
+                continue
+            waiting = _drain_backlog() if _backlog else 0
+            if waiting >= BACKLOG_MAX:
+                stop.wait(0.1)  # shards are busy: let them catch up before reading more
+                continue
+            if time.time() >= next_claim:
+                next_claim = time.time() + CLAIM_EVERY
+                _claim_stale(consumer, handler)
+            # with a backlog, come back soon to move it onto the shards
+            block = 100 if waiting else BLOCK_MS
+            batch = _r.xreadgroup(GROUP, consumer, {STREAM_KEY: ">"}, count=BATCH, block=block)
+            for _, entries in batch or []:
+                for entry_id, fields in entries:
+                    _process(entry_id, fields, handler)
+        except Exception as e:
+            print(f"[ingress.{consumer}] {e}")
+            next_heartbeat = 0
+            time.sleep(1)
+
+
+def start_ingress_consumers(threads: int = None):
+    """Start consumer threads in this process (idempotent)."""
+    if _threads:
+        return _threads
+    prefix = f"{socket.gethostname()}-{os.getpid()}"
+    threads = threads if threads is not None else settings.INGRESS_CONSUMERS
+    if sharded_dispatch.get_dispatcher() and threads > 1:
+        threads = 1  # one reader (the lease holder, across processes) keeps stream order
+    for n in range(threads):
+        t = Thread(target=run_consumer, args=(f"{prefix}-{n}",), name=f"ingress-{n}", daemon=True)
+        _threads.append(t)
+        t.start()
+    return _threads
+
+
+def ingress_stats() -> dict:
+    """Stream length, pending (delivered, not acked) entries and dead letters."""
+    pipe = _r.pipeline(transaction=False)
+    pipe.xlen(STREAM_KEY)
+    pipe.xpending(STREAM_KEY, GROUP)
+    pipe.xlen(DEAD_KEY)
+    try:
+        length, pending, dead = pipe.execute()
+    except Exception:  # no group yet
+        return {"length": _r.xlen(STREAM_KEY), "pending": 0, "dead": _r.xlen(DEAD_KEY)}
+    return {
+        "length": length,
+        "pending": pending["pending"],
+        "pending_by_consumer": {c["name"]: c["pending"] for c in pending.get("consumers") or []},
+        "dead": dead,
+    }
+
+
+if __name__ == "__main__":
+    from utils.db import init_db
+
+    init_db()
+    start_ingress_consumers(int(sys.argv[1]) if len(sys.argv) > 1 else settings.INGRESS_CONSUMERS or 4)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        _stop.set()
@@ -0,0 +1,241 @@
+# utils/jobs.py
+import time
+import uuid
+from apscheduler.schedulers.background import BackgroundScheduler
+from config import settings
+from utils.redis_client import get_redis
+
+_r = get_redis()
+
+# Small Redis-backed job queue for work that must not run inside a webhook
+# request (it outlives Telegram's timeout and dies with a recycled worker).
+#
+#   job:{id}                 hash  kind, state, owner, attempts, error, created_at,
+#                                  updated_at + the job's own fields (its checkpoint)
+#   jobs:pending             zset  id -> when it may be claimed next. A claim pushes
+#                                  the score to now + LEASE_SECONDS and every
+#                                  checkpoint extends it, so a job whose worker
+#                                  died becomes claimable again and resumes from
+#                                  its last checkpoint.
+#   jobs:active:{dedupe}     str   id of the unfinished job for that dedupe key
+#   jobs:last:{dedupe}       str   id of the latest job for that key (status lookups)
+#
+# Handlers are registered per kind with @job_handler("kind") and receive a Job.
+# They must be written to resume: read their progress from job.data and call
+# job.checkpoint(...) after each step. A handler that raises is queued again
+# after a backoff and resumes from its checkpoint; it only fails for good once
+# MAX_ATTEMPTS runs are used up, or right away if it raises JobFailed.
+
+PENDING_KEY = "jobs:pending"
+LEASE_SECONDS = 60
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF = 5  # seconds before the 2nd run, doubling per attempt
+RETRY_BACKOFF_MAX = 300
+POLL_INTERVAL = 1
+KEEP_FINISHED = 24 * 3600
+
+_handlers = {}
+scheduler = BackgroundScheduler()
+
+
+class JobLost(Exception):
+    """The lease expired and another worker owns the job now."""
+
+
+class JobFailed(Exception):
+    """Raised by a handler for an error retrying won't fix."""
+
+
+def job_key(job_id: str) -> str:
+    return f"job:{job_id}"
+
+
+def job_handler(kind: str):
+    def register(fn):
+        _handlers[kind] = fn
+        return fn
+    return register
+
+
+# KEYS: job hash, pending, active, last   ARGV: id, now, then field/value pairs
+_ENQUEUE_LUA = """
+local existing = redis.call('GET', KEYS[3])
+if existing and redis.call('EXISTS', 'job:' .. existing) == 1 then
+    return {existing, 0}
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+redis.call('SET', KEYS[3], ARGV[1])
+redis.call('SET', KEYS[4], ARGV[1])
+return {ARGV[1], 1}
+"""
+_enqueue_script = _r.register_script(_ENQUEUE_LUA)
+
+# KEYS: pending   ARGV: now, lease_until, owner
+_CLAIM_LUA = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, 1)
+if #ids == 0 then return false end
+local id = ids[1]
+redis.call('ZADD', KEYS[1], ARGV[2], id)
+redis.call('HSET', 'job:' .. id, 'owner', ARGV[3], 'state', 'running', 'updated_at', ARGV[1])
+redis.call('HINCRBY', 'job:' .. id, 'attempts', 1)
+return id
+"""
+_claim_script = _r.register_script(_CLAIM_LUA)
+
+# KEYS: job hash, pending   ARGV: id, owner, lease_until, then field/value pairs
+_CHECKPOINT_LUA = """
+if redis.call('HGET', KEYS[1], 'owner') ~= ARGV[2] then return 0 end
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+if #ARGV > 3 then redis.call('HSET', KEYS[1], unpack(ARGV, 4)) end
+return 1
+"""
+_checkpoint_script = _r.register_script(_CHECKPOINT_LUA)
+
+# KEYS: job hash, pending, active   ARGV: id, owner, state, error, now, keep_seconds
+_FINISH_LUA = """
+if redis.call('HGET', KEYS[1], 'owner') ~= ARGV[2] then return 0 end
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('HSET', KEYS[1], 'state', ARGV[3], 'error', ARGV[4], 'updated_at', ARGV[5])
+redis.call('EXPIRE', KEYS[1], ARGV[6])
+if redis.call('GET', KEYS[3]) == ARGV[1] then redis.call('DEL', KEYS[3]) end
+return 1
+"""
+_finish_script = _r.register_script(_FINISH_LUA)
+
+# KEYS: job hash, pending   ARGV: id, owner, run at, error, now
+_RETRY_LUA = """
+if redis.call('HGET', KEYS[1], 'owner') ~= ARGV[2] then return 0 end
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+redis.call('HSET', KEYS[1], 'state', 'retrying', 'owner', '', 'error', ARGV[4], 'updated_at', ARGV[5])
+return 1
+"""
+_retry_script = _r.register_script(_RETRY_LUA)
+
+
+def _flatten(fields: dict) -> list:
+    out = []
+    for k, v in fields.items():
+        out += [k, "" if v is None else v]
+    return out
+
+
+def enqueue(kind: str, dedupe: str, **fields):
+    """
+    Queue a job. While an unfinished job with the same dedupe key exists it is
+    returned instead of queueing another one. Returns (job_id, created).
+    """
+    job_id = uuid.uuid4().hex[:12]
+    now = time.time()
+    fields = {"kind": kind, "dedupe": dedupe, "state": "queued", "attempts": 0,
+              "created_at": now, "updated_at": now, **fields}
+    existing, created = _enqueue_script(
+        keys=[job_key(job_id), PENDING_KEY, f"jobs:active:{dedupe}", f"jobs:last:{dedupe}"],
+        args=[job_id, now, *_flatten(fields)],
+    )
+    return existing, bool(created)
+
+
+def get_job(job_id: str):
+    data = _r.hgetall(job_key(job_id)) if job_id else {}
+    return data or None
+
+
+def last_job(dedupe: str):
+    """Latest job (finished or not) queued under `dedupe`, as a dict, or None."""
+    return get_job(_r.get(f"jobs:last:{dedupe}"))
+
+
+class Job:
+    def __init__(self, job_id: str, owner: str):
+        self.id = job_id
+        self.owner = owner
+        self.data = _r.hgetall(job_key(job_id))
+        self.kind = self.data.get("kind")
+
+    def checkpoint(self, **fields):
+        """Persist progress and extend the lease. Raises JobLost if we no longer own it."""
+        fields["updated_at"] = time.time()
+        ok = _checkpoint_script(
+            keys=[job_key(self.id), PENDING_KEY],
+            args=[self.id, self.owner, time.time() + LEASE_SECONDS, *_flatten(fields)],
+        )
+        if not ok:
+            raise JobLost(self.id)
+        self.data.update({k: str(v) for k, v in fields.items()})
+
+    def finish(self, state: str = "done", error: str = ""):
+        _finish_script(
+            keys=[job_key(self.id), PENDING_KEY, f"jobs:active:{self.data.get('dedupe')}"],
+            args=[self.id, self.owner, state, error, time.time(), KEEP_FINISHED],
+        )
+
+    def retry(self, error: str = ""):
+        """Give the job back, to be claimed again after a backoff that doubles per attempt."""
+        attempts = int(self.data.get("attempts", 1))
+        delay = min(RETRY_BACKOFF * 2 ** (attempts - 1), RETRY_BACKOFF_MAX)
+        _retry_script(
+            keys=[job_key(self.id), PENDING_KEY],
+            args=[self.id, self.owner, time.time() + delay, error, time.time()],
+        )
+        return delay
+
+
+def run_next_job() -> bool:
+    """Claim and run one due job. Returns False when there was nothing to run."""
+    owner = uuid.uuid4().hex
+    now = time.time()
+    job_id = _claim_script(keys=[PENDING_KEY], args=[now, now + LEASE_SECONDS, owner])
+    if not job_id:
+        return False
+
+    job = Job(job_id, owner)
+    handler = _handlers.get(job.kind)
+    if handler is None:
+        job.finish("failed", f"no handler for {job.kind!r}")
+        return True
+    if int(job.data.get("attempts", 1)) > MAX_ATTEMPTS:
+        job.finish("failed", "too many attempts")
+        return True
+
+    try:
+        handler(job)
+        job.finish("done")
+    except JobLost:
+        print(f"[jobs] {job.kind} {job_id}: lease lost, another worker resumed it")
+    except JobFailed as e:
+        print(f"[jobs] {job.kind} {job_id} failed: {e}")
+        job.finish("failed", str(e))
+    except Exception as e:
+        if int(job.data.get("attempts", 1)) >= MAX_ATTEMPTS:
+            print(f"[jobs] {job.kind} {job_id} failed after {MAX_ATTEMPTS} attempts: {e}")
+            job.finish("failed", str(e))
+        else:
+            delay = job.retry(str(e))
+            print(f"[jobs] {job.kind} {job_id}: {e}; retrying in {delay}s")
+    return True
+
+
+def _poll_job():
+    try:
+        while run_next_job():
+            pass
+    except Exception as e:
+        print(f"[jobs.poll] {e}")
+
+
+def start_job_workers(workers: int = None):
+    """Run up to `workers` jobs at once in this process (idempotent)."""
+    if scheduler.get_job("jobs_poll"):
+        return scheduler
+    scheduler.add_job(
+        _poll_job,
+        "interval",
+        seconds=POLL_INTERVAL,
+        id="jobs_poll",
+        max_instances=workers or settings.JOB_WORKERS,
+        coalesce=True,
+    )
+    if not scheduler.running:
+        scheduler.start()
+    return scheduler
@@ -0,0 +1,52 @@
+# utils/media_registry.py
+import os
+from telebot.apihelper import ApiTelegramException
+from utils.redis_client import get_redis
+
+_r = get_redis()
+
+# Bundled media (gifs/*.mp4) is uploaded once per bot and sent by file_id
+# afterwards:
+#
+#   media:{bot id}:{file name}  str  file_id Telegram returned for that bot
+#
+# file_ids only work for the bot that received them, hence the bot id (the
+# numeric part of the token) in the key. If Telegram rejects a stored id the
+# file is uploaded again and the new id replaces it.
+
+MEDIA_DIR = "gifs"
+
+
+def _key(bot, name: str) -> str:
+    return f"media:{bot.token.split(':')[0]}:{name}"
+
+
+def _file_id(msg):
+    media = msg.video or msg.animation or msg.document
+    return media.file_id if media else None
+
+
+def _rejected(e: ApiTelegramException) -> bool:
+    # "wrong file identifier/HTTP URL specified", "wrong remote file identifier", ...
+    return e.error_code == 400 and "file" in (e.description or "").lower()
+
+
+def send_video(bot, chat_id, name: str):
+    """Send gifs/<name>, by cached file_id when this bot has one. Returns the Message."""
+    key = _key(bot, name)
+    file_id = _r.get(key)
+    if file_id:
+        try:
+            return bot.send_video(chat_id, file_id)
+        except ApiTelegramException as e:
+            if not _rejected(e):
+                raise
+            print(f"[media_registry] {name}: cached file_id rejected, uploading again")
+            _r.delete(key)
+
+    with open(os.path.join(MEDIA_DIR, name), "rb") as f:
+        msg = bot.send_video(chat_id, f)
+    file_id = _file_id(msg)
+    if file_id:
+        _r.set(key, file_id)
+    return msg
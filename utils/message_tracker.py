@@ -1,114 +1,294 @@
 # utils/message_tracker.py
 import json
+import time
+from config import settings
 from utils.redis_client import get_redis
+from utils import tracker_bitmap
+from utils.jobs import enqueue, job_handler, job_key, last_job, JobFailed
+from utils.update_context import deferred_batch
 
 _r = get_redis()
 
-# Redis key pattern: tracked:{bot_id}:{chat_id}
-# We use a Redis set to avoid duplicates, atomic ops to prevent race conditions
+# Redis key pattern: tracked_at:{bot_id}:{chat_id}
+# Sorted set message_id -> unix time it was tracked, so deletion can skip
+# messages Telegram no longer lets us delete, clear an age window ("/clear 2h")
+# and trim expired ids one by one instead of the whole key expiring at once.
+#
+# tracked:{bot_id}:{chat_id} is the old untimed set; it is no longer written
+# but is still drained by full clears until its own TTL runs out.
+#
+# TRACKER_ENCODING=bitmap writes chunked bitmaps instead (utils/tracker_bitmap.py).
+# Deletion and counts always cover both encodings, so switching is safe
+# in either direction.
 
-DEFAULT_TTL = 48 * 3600  # auto-expire in 24h
+DEFAULT_TTL = 48 * 3600  # auto-expire in 48h
+DELETE_BATCH = 100  # max ids per deleteMessages call
+DELETE_WINDOW = 48 * 3600 - 300  # Telegram refuses deletes after 48h; keep a margin
+
+
+def _tracked_key(bot_id: str, chat_id: int) -> str:
+    return f"tracked_at:{bot_id}:{chat_id}"
+
+
+def _legacy_key(bot_id: str, chat_id: int) -> str:
+    return f"tracked:{bot_id}:{chat_id}"
+
+
+def _write_tracked(pipe, batch: dict):
+    for (bot_id, chat_id), (ids, ttl) in batch.items():
+        now = max(ids.values())
+        if settings.TRACKER_ENCODING == "bitmap":
+            tracker_bitmap.write(pipe, bot_id, chat_id, ids, ttl, now - ttl)
+            continue
+        key = _tracked_key(bot_id, chat_id)
+        pipe.zadd(key, ids)
+        pipe.zremrangebyscore(key, "-inf", f"({now - ttl}")  # incremental trim
+        pipe.expire(key, ttl)  # whole key goes once nothing was tracked for a TTL
 
 
 def track_message(chat_id: int, message_id: int, bot_id: str = None, ttl: int = DEFAULT_TTL):
     """
     Save a message ID in Redis for later deletion.
+    Inside an update the ids are buffered and written with the update's other
+    deferred writes (one ZADD + trim + EXPIRE per chat); otherwise one pipeline now.
     """
     if not bot_id:
         bot_id = "default"
-    key = f"tracked:{bot_id}:{chat_id}"
+    key = (bot_id, chat_id)
+    now = time.time()
+
+    batch = deferred_batch("tracked", _write_tracked)
+    if batch is not None:
+        ids, old_ttl = batch.get(key, ({}, 0))
+        ids[message_id] = now
+        batch[key] = (ids, max(old_ttl, ttl))
+        return
+
     try:
-        _r.sadd(key, message_id)
-        _r.expire(key, ttl)  # auto-clean after TTL
+        pipe = _r.pipeline(transaction=False)
+        _write_tracked(pipe, {key: ({message_id: now}, ttl)})
+        pipe.execute()
     except Exception as e:
         print(f"[track_message] Redis error: {e}")
 
 
-def delete_tracked_messages(bot, chat_id: int, bot_id: str = None):
+def _delete_batch(bot, chat_id: int, mids: list):
+    """
+    Delete up to DELETE_BATCH messages with one deleteMessages call.
+    If the bulk call is rejected, retry them one by one so a single bad id
+    doesn't keep the rest of the batch in the chat.
     """
-    Delete all tracked messages for this chat.
+    mids = sorted(int(mid) for mid in mids)
+    try:
+        bot.delete_messages(chat_id, mids)
+        return
+    except Exception as e:
+        print(f"[delete_tracked_messages] Bulk delete of {len(mids)} failed, retrying singly: {e}")
+    for mid in mids:
+        try:
+            bot.delete_message(chat_id, mid)
+        except Exception as e:
+            # Ignore "message not found" or permission errors
+            print(f"[delete_tracked_messages] Failed to delete {mid}: {e}")
+
+
+# Pops the next batch of deletable ids, oldest first, and (for jobs)
+# records it as the job's inflight batch in the same call.
+# Ids older than Telegram's delete window are dropped without an API call.
+# KEYS: tracked zset, legacy set[, job hash]
+# ARGV: oldest score to delete, undeletable-before score, batch size, drain legacy (1/0)
+_POP_BATCH_LUA = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[2])
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[1], '+inf', 'LIMIT', 0, tonumber(ARGV[3]))
+if #ids > 0 then
+    redis.call('ZREM', KEYS[1], unpack(ids))
+elseif ARGV[4] == '1' then
+    ids = redis.call('SPOP', KEYS[2], ARGV[3])
+end
+if #ids > 0 and KEYS[3] then
+    redis.call('HSET', KEYS[3], 'inflight', table.concat(ids, ','))
+end
+return ids
+"""
+_pop_batch_script = _r.register_script(_POP_BATCH_LUA)
+
+
+def _window(max_age: int = None):
+    """(oldest deletable score, undeletable-before score) for a clear of `max_age` seconds."""
+    stale_before = time.time() - DELETE_WINDOW
+    return max(stale_before, time.time() - max_age) if max_age else stale_before, stale_before
+
+
+def _pop_batch(bot_id: str, chat_id: int, max_age: int = None, job_id: str = None) -> list:
+    oldest, stale_before = _window(max_age)
+    job_hash = job_key(job_id) if job_id else None
+    if settings.TRACKER_ENCODING == "bitmap":
+        mids = tracker_bitmap.pop_batch(bot_id, chat_id, oldest, stale_before, DELETE_BATCH, job_hash)
+        if mids:
+            return mids
+    keys = [_tracked_key(bot_id, chat_id), _legacy_key(bot_id, chat_id)]
+    if job_hash:
+        keys.append(job_hash)
+    # untimed legacy ids can't be placed in an age window, so only full clears drain them
+    mids = _pop_batch_script(keys=keys, args=[oldest, stale_before, DELETE_BATCH, 0 if max_age else 1])
+    if not mids and settings.TRACKER_ENCODING != "bitmap":
+        # leftovers from a time the bitmap encoding was enabled
+        mids = tracker_bitmap.pop_batch(bot_id, chat_id, oldest, stale_before, DELETE_BATCH, job_hash)
+    return mids
+
+
+def count_tracked(chat_id: int, bot_id: str = None, max_age: int = None) -> int:
+    """How many tracked messages a clear of `max_age` seconds (None = all) would delete."""
+    if not bot_id:
+        bot_id = "default"
+    oldest = _window(max_age)[0]
+    pipe = _r.pipeline(transaction=False)
+    pipe.zcount(_tracked_key(bot_id, chat_id), oldest, "+inf")
+    tracker_bitmap.count(pipe, bot_id, chat_id, oldest)
+    pipe.scard(_legacy_key(bot_id, chat_id))
+    timed, bits, legacy = pipe.execute()
+    return timed + bits + (0 if max_age else legacy)
+
+
+def delete_tracked_messages(bot, chat_id: int, bot_id: str = None, max_age: int = None):
+    """
+    Delete all tracked messages for this chat (or those of the last `max_age` seconds).
     Works safely across multiple Gunicorn workers.
     """
     if not bot_id:
         bot_id = "default"
-    key = f"tracked:{bot_id}:{chat_id}"
 
     try:
         while True:
-            mid = _r.spop(key)  # atomic pop ensures no race condition
-            if mid is None:
+            mids = _pop_batch(bot_id, chat_id, max_age)  # atomic pop ensures no race condition
+            if not mids:
                 break
-            try:
-                bot.delete_message(chat_id, int(mid))
-            except Exception as e:
-                # Ignore "message not found" or permission errors
-                print(f"[delete_tracked_messages] Failed to delete {mid}: {e}")
+            _delete_batch(bot, chat_id, mids)
     except Exception as e:
         print(f"[delete_tracked_messages] Redis error: {e}")
 
-def delete_tracked_messages_with_progress(bot, chat_id: int, bot_id: str = None):
+def _progress_text(deleted: int, total: int, bar_length: int = 10):
+    """Progress bar text plus how many bar cells are filled."""
+    filled = int(bar_length * deleted / total)
+    percent = int((deleted / total) * 100)
+    bar = "█" * filled + "░" * (bar_length - filled)
+    return f"🧹 Deleting {total} messages...\nProgress: {percent}% [{bar}]", filled
+
+
+# ---------------- Background /clear ----------------
+# /clear runs as a utils.jobs job, not inside the webhook. Its checkpoint lives
+# in the job hash: deleted/total/shown progress and "inflight", the batch popped
+# from the tracked set but not yet confirmed deleted. Popping a batch and
+# recording it as inflight is one script (_POP_BATCH_LUA), so a worker dying
+# mid-batch loses no ids; whoever resumes the job deletes the inflight batch
+# again first.
+
+
+def _clear_dedupe(chat_id: int, bot_id: str) -> str:
+    return f"clear:{bot_id}:{chat_id}"
+
+
+def start_clear_job(bot, chat_id: int, bot_id: str = None, max_age: int = None):
     """
-    Delete tracked messages with a live progress bar.
-    Updates one Telegram message as progress indicator.
+    Queue a background deletion of this chat's tracked messages (or those of
+    the last `max_age` seconds) and return right away.
+    Returns the job id, or None if there was nothing to delete.
     """
     if not bot_id:
         bot_id = "default"
-    key = f"tracked:{bot_id}:{chat_id}"
 
-    try:
-        total = _r.scard(key)
-        if total == 0:
-            bot.send_message(chat_id, "ℹ️ No tracked messages to delete.")
-            return
+    total = count_tracked(chat_id, bot_id, max_age)
+    if total == 0:
+        bot.send_message(chat_id, "ℹ️ No tracked messages to delete.")
+        return None
 
-        progress_msg = bot.send_message(chat_id, f"🧹 Deleting {total} messages...\nProgress: 0% [░░░░░░░░░░]")
+    progress_msg = bot.send_message(chat_id, _progress_text(0, total)[0])
+    job_id, created = enqueue(
+        "clear",
+        dedupe=_clear_dedupe(chat_id, bot_id),
+        bot_id=bot_id,
+        chat_id=chat_id,
+        max_age=max_age or 0,
+        total=total,
+        deleted=0,
+        shown=0,
+        inflight="",
+        progress_msg_id=progress_msg.message_id,
+    )
+    if not created:
+        bot.edit_message_text("⏳ Already clearing this chat. Use /clearstatus to follow it.", chat_id, progress_msg.message_id)
+    return job_id
 
-        deleted = 0
-        bar_length = 10
 
-        while True:
-            mid = _r.spop(key)
-            if mid is None:
-                break
+@job_handler("clear")
+def _run_clear_job(job):
+    from utils.telegram import manager  # utils.telegram imports the handlers that import us
+
+    bot_id = job.data["bot_id"]
+    chat_id = int(job.data["chat_id"])
+    progress_id = int(job.data["progress_msg_id"])
+    total, deleted, shown = int(job.data["total"]), int(job.data["deleted"]), int(job.data["shown"])
+    max_age = int(job.data.get("max_age") or 0) or None
+
+    bot = manager.create_or_get_child(bot_id)
+    if bot is None:
+        raise JobFailed(f"bot {bot_id} is not available")
+
+    inflight = job.data.get("inflight")
+    while True:
+        if inflight:
+            mids, inflight = inflight.split(","), None  # resuming: redo the unconfirmed batch
+        else:
+            mids = _pop_batch(bot_id, chat_id, max_age, job_id=job.id)
+        if not mids:
+            break
+        _delete_batch(bot, chat_id, mids)
+        deleted += len(mids)
+        total = max(total, deleted)
+
+        text, filled = _progress_text(deleted, total)
+        if filled != shown:
+            shown = filled
             try:
-                bot.delete_message(chat_id, int(mid))
+                bot.edit_message_text(text, chat_id, progress_id)
             except Exception:
                 pass
-            deleted += 1
-
-            # Update progress every ~10% or last
-            if deleted == total or deleted % max(1, total // bar_length) == 0:
-                percent = int((deleted / total) * 100)
-                filled = int(bar_length * deleted / total)
-                bar = "█" * filled + "░" * (bar_length - filled)
-                try:
-                    bot.edit_message_text(
-                        f"🧹 Deleting {total} messages...\nProgress: {percent}% [{bar}]",
-                        chat_id,
-                        progress_msg.message_id
-                    )
-                except Exception:
-                    pass
-
-        bot.edit_message_text(
-            f"✅ Deleted {deleted}/{total} tracked messages.",
-            chat_id,
-            progress_msg.message_id
-        )
+        job.checkpoint(deleted=deleted, total=total, shown=shown, inflight="")
 
-    except Exception as e:
-        print(f"[delete_tracked_messages_with_progress] Redis error: {e}")
-        bot.send_message(chat_id, "⚠️ Failed to delete tracked messages.")
+    try:
+        bot.edit_message_text(f"✅ Deleted {deleted}/{total} tracked messages.", chat_id, progress_id)
+    except Exception:
+        pass
+
+
+def clear_job_status(chat_id: int, bot_id: str = None) -> str:
+    """Human-readable state of the latest /clear job for this chat."""
+    if not bot_id:
+        bot_id = "default"
+    job = last_job(_clear_dedupe(chat_id, bot_id))
+    if not job:
+        return "ℹ️ No /clear has run here recently."
+
+    progress = f"{job.get('deleted', 0)}/{job.get('total', 0)}"
+    state = job.get("state")
+    if state == "queued":
+        return f"⏳ /clear is queued ({job.get('total', 0)} messages)."
+    if state == "running":
+        return f"🧹 /clear is running: deleted {progress}."
+    if state == "retrying":
+        return f"⏳ /clear hit an error after {progress} and will retry shortly: {job.get('error')}"
+    if state == "done":
+        return f"✅ Last /clear finished: deleted {progress}."
+    return f"⚠️ Last /clear stopped after {progress}: {job.get('error') or state}"
 
 
 def clear_chat_tracking(chat_id: int, bot_id: str = None):
     """
-    Just clear the Redis set without trying to delete messages.
+    Just clear the tracked ids without trying to delete messages.
     """
     if not bot_id:
         bot_id = "default"
-    key = f"tracked:{bot_id}:{chat_id}"
     try:
-        _r.delete(key)
+        _r.delete(_tracked_key(bot_id, chat_id), _legacy_key(bot_id, chat_id), *tracker_bitmap.bitmap_keys(bot_id, chat_id))
     except Exception as e:
         print(f"[clear_chat_tracking] Redis error: {e}")
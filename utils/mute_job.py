@@ -0,0 +1,178 @@
+# utils/mute_job.py
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from utils.redis_client import get_redis
+from utils.jobs import enqueue, job_handler, job_key, KEEP_FINISHED, JobFailed
+from utils.message_tracker import track_message
+from utils import outbound
+
+_r = get_redis()
+
+# /muteunsafe as a background job (utils/jobs.py). The users and the mute's
+# end time are fixed when the job is queued, so a resumed job mutes the same
+# people until the same moment.
+#
+#   job:{id}:muted       set   user ids already muted by this job
+#   job:{id}:failed      hash  user id -> first name, for the summary
+#   mute_lock:{bot_id}:{chat_id}:{user_id}
+#                        str   held while one worker mutes that user
+#
+# A user is skipped once in either set, so a retried or taken-over job never
+# mutes anyone twice. Users still locked by someone else after the last pass
+# go into the failed hash, so the summary names them. Up to MUTE_CONCURRENCY restrictChatMember calls run at
+# once, each taking a token from the bot's outbound rate limit first.
+
+MUTE_CONCURRENCY = 4
+MUTE_BATCH = 20  # users per checkpoint
+MUTE_LOCK_SECONDS = 30
+MUTE_PASSES = 3
+
+# KEYS: lock  ARGV: token -- only the holder may release the lock
+_RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end
+return 0
+"""
+_release_script = _r.register_script(_RELEASE_LUA)
+
+
+def _mute_dedupe(chat_id: int, bot_id: str) -> str:
+    return f"mute:{bot_id}:{chat_id}"
+
+
+def _progress_text(done: int, total: int, bar_length: int = 10):
+    """Progress bar text plus how many bar cells are filled."""
+    filled = int(bar_length * done / total)
+    percent = int((done / total) * 100)
+    bar = "█" * filled + "░" * (bar_length - filled)
+    return f"🔇 Muting {total} unsafe users...\nProgress: {percent}% [{bar}]", filled
+
+
+def start_mute_job(bot, chat_id: int, bot_id: str, users: list, duration):
+    """
+    Queue muting `users` ({user_id, first_name, ...} dicts) for `duration`
+    and return right away. Returns the job id.
+    """
+    users = [{"user_id": u["user_id"], "first_name": u.get("first_name") or "User"} for u in users]
+    until = int(time.time() + duration.total_seconds())
+
+    progress_msg = bot.send_message(chat_id, _progress_text(0, len(users))[0])
+    track_message(chat_id, progress_msg.message_id, bot_id=bot_id)
+    job_id, created = enqueue(
+        "mute",
+        dedupe=_mute_dedupe(chat_id, bot_id),
+        bot_id=bot_id,
+        chat_id=chat_id,
+        until=until,
+        users=json.dumps(users),
+        total=len(users),
+        done=0,
+        shown=0,
+        progress_msg_id=progress_msg.message_id,
+    )
+    if not created:
+        bot.edit_message_text("⏳ Already muting unsafe users in this chat.", chat_id, progress_msg.message_id)
+    return job_id
+
+
+def _mute_one(bot, bot_id: str, chat_id: int, user: dict, until_date, muted_key: str, failed_key: str) -> bool:
+    """Mute one user unless another worker is on it. False = skipped for now."""
+    from utils.telegram import mute_user  # utils.telegram imports the handlers that import us
+
+    uid = user["user_id"]
+    lock = f"mute_lock:{bot_id}:{chat_id}:{uid}"
+    token = uuid.uuid4().hex
+    if not _r.set(lock, token, nx=True, ex=MUTE_LOCK_SECONDS):
+        return False
+    try:
+        if _r.sismember(muted_key, uid):
+            return True
+        bot_key = bot.token.split(":")[0]
+        if not outbound.throttle(outbound.bot_limit(bot_key), timeout=MUTE_LOCK_SECONDS):
+            return False
+        pipe = _r.pipeline(transaction=False)
+        if mute_user(bot, chat_id, uid, until_date=until_date, notify=False):
+            pipe.sadd(muted_key, uid)
+            pipe.expire(muted_key, KEEP_FINISHED)
+        else:
+            pipe.hset(failed_key, uid, user["first_name"])
+            pipe.expire(failed_key, KEEP_FINISHED)
+        pipe.execute()
+        return True
+    finally:
+        _release_script(keys=[lock], args=[token])
+
+
+@job_handler("mute")
+def _run_mute_job(job):
+    from utils.telegram import manager
+
+    bot_id = job.data["bot_id"]
+    chat_id = int(job.data["chat_id"])
+    progress_id = int(job.data["progress_msg_id"])
+    until_date = datetime.fromtimestamp(int(job.data["until"]), tz=timezone.utc)
+    users = json.loads(job.data["users"])
+    total, shown = int(job.data["total"]), int(job.data["shown"])
+
+    bot = manager.create_or_get_child(bot_id)
+    if bot is None:
+        raise JobFailed(f"bot {bot_id} is not available")
+
+    muted_key, failed_key = f"{job_key(job.id)}:muted", f"{job_key(job.id)}:failed"
+
+    def finished():
+        pipe = _r.pipeline(transaction=False)
+        pipe.smembers(muted_key)
+        pipe.hgetall(failed_key)
+        muted, failed = pipe.execute()
+        return muted, failed
+
+    with ThreadPoolExecutor(max_workers=MUTE_CONCURRENCY) as pool:
+        for _ in range(MUTE_PASSES):  # users another worker held locked get picked up on the next pass
+            muted, failed = finished()
+            todo = [u for u in users if str(u["user_id"]) not in muted and str(u["user_id"]) not in failed]
+            if not todo:
+                break
+            for i in range(0, len(todo), MUTE_BATCH):
+                batch = todo[i:i + MUTE_BATCH]
+                list(pool.map(lambda u: _mute_one(bot, bot_id, chat_id, u, until_date, muted_key, failed_key), batch))
+
+                muted, failed = finished()
+                done = len(muted) + len(failed)
+                text, filled = _progress_text(done, total)
+                if filled != shown:
+                    shown = filled
+                    try:
+                        bot.edit_message_text(text, chat_id, progress_id)
+                    except Exception:
+                        pass
+                job.checkpoint(done=done, shown=shown)
+            time.sleep(1)
+
+    muted, failed = finished()
+    skipped = [u for u in users if str(u["user_id"]) not in muted and str(u["user_id"]) not in failed]
+    if skipped:
+        _r.hset(failed_key, mapping={u["user_id"]: u["first_name"] for u in skipped})
+        _r.expire(failed_key, KEEP_FINISHED)
+        muted, failed = finished()
+    success_log = []
+    for user in users:
+        uid = user["user_id"]
+        if str(uid) in muted:
+            mention = f'<a href="tg://user?id={uid}">{user["first_name"]}</a>'
+            success_log.append(f"• {mention} (ID: <code>{uid}</code>)")
+
+    msg_text = "<b>🔇 Muted the following unSafe users:</b>\n\n" + "\n".join(success_log)
+    if failed:
+        msg_text += "\n\n⚠️ <b>Failed to mute:</b>\n" + "\n".join(f"• {name}" for name in failed.values())
+    try:
+        bot.edit_message_text(f"✅ Muted {len(muted)}/{total} unsafe users.", chat_id, progress_id)
+    except Exception:
+        pass
+    try:
+        msg = bot.send_message(chat_id, msg_text, parse_mode="HTML")
+        track_message(chat_id, msg.message_id, bot_id=bot_id)
+    except Exception as e:
+        print(f"[mute_job] summary for chat {chat_id} not sent: {e}")
@@ -0,0 +1,418 @@
+# utils/outbound.py
+import itertools
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Condition, Thread
+from typing import NamedTuple
+from telebot import apihelper
+from config import settings
+from utils.redis_client import get_redis
+
+_r = get_redis()
+
+# Outbound Telegram calls, rate limited across every worker process.
+#
+# Installed as telebot's CUSTOM_REQUEST_SENDER, so handlers keep calling
+# bot.send_message / reply_to / edit_message_text and still get the Message
+# back. Message-producing methods (send*, edit*, forward*, copy*) are queued
+# and sent by a few dispatcher threads once both token buckets allow it:
+#
+#   rl:bot:{bot id}             OUTBOUND_BOT_PER_SECOND for the whole bot token
+#   rl:chat:{bot id}:{chat id}  OUTBOUND_GROUP_PER_MINUTE in groups,
+#                               PRIVATE_PER_SECOND in private chats
+#
+# Buckets are Redis hashes (tokens, ts, blocked) so every process shares them.
+# A 429 blocks the chat's bucket (the bot's for chatless calls) for
+# retry_after and the call is retried. The queue is ordered by priority (HIGH
+# for admin command replies, LOW for bulk notices), set per update with
+# `with priority(HIGH):`. Anything else (getChatAdministrators,
+# restrictChatMember, ...) is sent directly, with the same 429 handling.
+#
+# A caller waits at most OUTBOUND_MAX_WAIT for its queued call, well inside
+# the webhook timeout. Notices nobody needs the Message of go through
+# detached(): the call is queued and the handler moves on; the worker hands
+# the message_id to a callback (track_message) once Telegram accepted it.
+#
+# take()/throttle() are usable on their own for batch work that talks to
+# Telegram outside of this queue.
+
+HIGH, NORMAL, LOW = 0, 1, 2
+PRIORITY_NAMES = {HIGH: "high", NORMAL: "normal", LOW: "low"}
+
+PRIVATE_PER_SECOND = 1
+MAX_RETRIES = 3
+DETACHED_MAX_AGE = 300  # seconds a detached notice may sit in the queue before it's dropped
+
+_QUEUED_METHOD = re.compile(r"^(send(?!ChatAction)|edit|forward|copy)")
+_URL = re.compile(r"/bot([^/]+)/(\w+)$")
+
+_priority = ContextVar("outbound_priority", default=NORMAL)
+_detach = ContextVar("outbound_detach", default=None)  # [on_sent] inside detached()
+
+
+class Limit(NamedTuple):
+    key: str
+    rate: float    # tokens per second
+    burst: int     # bucket size
+
+
+class OutboundTimeout(Exception):
+    """The call wasn't done within OUTBOUND_MAX_WAIT (or a detached one within DETACHED_MAX_AGE)."""
+
+
+class _Detached(Exception):
+    """Raised through the bot call once detached() queued its request."""
+
+
+def bot_limit(bot_key: str) -> Limit:
+    return Limit(f"rl:bot:{bot_key}", settings.OUTBOUND_BOT_PER_SECOND, settings.OUTBOUND_BOT_PER_SECOND)
+
+
+def chat_limit(bot_key: str, chat_id) -> Limit:
+    try:
+        private = int(chat_id) > 0
+    except (TypeError, ValueError):
+        private = False  # @channelusername
+    if private:
+        return Limit(f"rl:chat:{bot_key}:{chat_id}", PRIVATE_PER_SECOND, PRIVATE_PER_SECOND)
+    per_minute = settings.OUTBOUND_GROUP_PER_MINUTE
+    return Limit(f"rl:chat:{bot_key}:{chat_id}", per_minute / 60, per_minute)
+
+
+# KEYS: bucket hashes   ARGV: now (ms), then (tokens per ms, burst) per key
+# Takes one token from every bucket or none; returns 0 or ms until possible.
+_TAKE_LUA = """
+local now = tonumber(ARGV[1])
+local wait = 0
+local level = {}
+for i, key in ipairs(KEYS) do
+    local rate, burst = tonumber(ARGV[2 * i]), tonumber(ARGV[2 * i + 1])
+    local b = redis.call('HMGET', key, 'tokens', 'ts', 'blocked')
+    local tokens = tonumber(b[1]) or burst
+    local ts = tonumber(b[2]) or now
+    local blocked = tonumber(b[3]) or 0
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+    level[i] = tokens
+    if blocked > now then
+        wait = math.max(wait, blocked - now)
+    elseif tokens < 1 then
+        wait = math.max(wait, math.ceil((1 - tokens) / rate))
+    end
+end
+if wait > 0 then return wait end
+for i, key in ipairs(KEYS) do
+    local rate, burst = tonumber(ARGV[2 * i]), tonumber(ARGV[2 * i + 1])
+    redis.call('HSET', key, 'tokens', tostring(level[i] - 1), 'ts', now)
+    redis.call('PEXPIRE', key, math.ceil(burst / rate) + 1000)
+end
+return 0
+"""
+_take_script = _r.register_script(_TAKE_LUA)
+
+# KEYS: bucket hash   ARGV: blocked until (ms), ttl (ms)
+_BLOCK_LUA = """
+local cur = tonumber(redis.call('HGET', KEYS[1], 'blocked')) or 0
+if tonumber(ARGV[1]) > cur then redis.call('HSET', KEYS[1], 'blocked', ARGV[1]) end
+if redis.call('PTTL', KEYS[1]) < tonumber(ARGV[2]) then redis.call('PEXPIRE', KEYS[1], ARGV[2]) end
+"""
+_block_script = _r.register_script(_BLOCK_LUA)
+
+
+def take(*limits: Limit) -> float:
+    """Take a token from every bucket at once. Returns 0, or seconds to wait before trying again."""
+    args = [int(time.time() * 1000)]
+    for limit in limits:
+        args += [limit.rate / 1000, limit.burst]
+    wait_ms = _take_script(keys=[l.key for l in limits], args=args)
+    return int(wait_ms) / 1000
+
+
+def throttle(*limits: Limit, timeout: float = None) -> bool:
+    """Block until take() succeeds. Returns False if that would exceed `timeout` seconds."""
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+        wait = take(*limits)
+        if not wait:
+            return True
+        if deadline is not None and time.time() + wait > deadline:
+            return False
+        time.sleep(wait)
+
+
+def block(limit: Limit, seconds: float):
+    """Keep the bucket empty for `seconds` (after a 429 with retry_after)."""
+    until = int((time.time() + seconds) * 1000)
+    _block_script(keys=[limit.key], args=[until, int(seconds * 1000) + 1000])
+
+
+@contextmanager
+def priority(level: int):
+    """Queue the sends made inside the block at `level` (HIGH, NORMAL or LOW)."""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def retry_after(response) -> float:
+    """retry_after of a 429 response, in seconds (0 when it isn't one)."""
+    if getattr(response, "status_code", None) != 429:
+        return 0
+    try:
+        return float(response.json().get("parameters", {}).get("retry_after") or 1)
+    except Exception:
+        return 1
+
+
+def _rewind(files):
+    for value in (files or {}).values():
+        f = value[1] if isinstance(value, tuple) else value
+        if hasattr(f, "seek"):
+            f.seek(0)
+
+
+# ---- dispatcher ----
+
+class _Send:
+    def __init__(self, level, method, url, kwargs, limits):
+        self.priority = level
+        self.seq = next(_seq)
+        self.method = method
+        self.url = url
+        self.kwargs = kwargs
+        self.limits = limits
+        self.enqueued = time.time()
+        self.not_before = 0
+        self.attempts = 0
+        self.done = False
+        self.result = None
+        self.error = None
+        self.detached = False  # nobody waits: the worker reports the outcome
+        self.on_sent = None
+
+
+_seq = itertools.count()
+_cond = Condition()
+_pending = []
+_blocked = {}  # bucket key -> local copy of "not before" so a busy chat isn't polled per message
+_workers = []
+_inflight = 0
+_stats = {"sent": 0, "throttled": 0, "retry_after": 0, "timeouts": 0, "errors": 0}
+
+
+def _ready_at(item) -> float:
+    return max([item.not_before] + [_blocked.get(l.key, 0) for l in item.limits])
+
+
+def _next_item():
+    """Block until an item is ready, then take the highest-priority one."""
+    global _inflight
+    with _cond:
+        while True:
+            now = time.time()
+            if len(_blocked) > 1000:
+                for key in [k for k, at in _blocked.items() if at <= now]:
+                    del _blocked[key]
+            best, soonest = None, None
+            for item in _pending:
+                at = _ready_at(item)
+                if at <= now:
+                    if best is None or (item.priority, item.seq) < (best.priority, best.seq):
+                        best = item
+                elif soonest is None or at < soonest:
+                    soonest = at
+            if best is not None:
+                _pending.remove(best)
+                _inflight += 1
+                return best
+            _cond.wait(None if soonest is None else soonest - now)
+
+
+def _requeue(item, at: float):
+    global _inflight
+    with _cond:
+        _inflight -= 1
+        item.not_before = at
+        _pending.append(item)
+        _cond.notify_all()
+
+
+def _finish(item, result=None, error=None):
+    global _inflight
+    with _cond:
+        _inflight -= 1
+        item.result, item.error, item.done = result, error, True
+        _stats["errors" if error else "sent"] += 1
+        _cond.notify_all()
+    if item.detached:
+        _report_detached(item)
+
+
+def _report_detached(item):
+    """Log a failed detached send, or pass the sent message's id to on_sent."""
+    name = item.url.rsplit("/", 1)[-1]
+    try:
+        if item.error:
+            raise item.error
+        body = item.result.json()
+        if not body.get("ok"):
+            print(f"[outbound.{name}] {body.get('error_code')}: {body.get('description')}")
+            return
+        result = body.get("result")
+        if item.on_sent and isinstance(result, dict) and "message_id" in result:
+            item.on_sent(result["message_id"])
+    except Exception as e:
+        print(f"[outbound.{name}] {e}")
+
+
+def _worker():
+    while True:
+        item = _next_item()
+        if item.detached and time.time() - item.enqueued > DETACHED_MAX_AGE:
+            _finish(item, error=OutboundTimeout(f"not sent within {DETACHED_MAX_AGE}s, dropped"))
+            continue
+        try:
+            wait = take(*item.limits)
+        except Exception as e:
+            print(f"[outbound.take] {e}")
+            wait = 0  # Redis down: send unthrottled rather than not at all
+        if wait:
+            with _cond:
+                _stats["throttled"] += 1
+                at = time.time() + wait
+                for limit in item.limits:
+                    _blocked[limit.key] = max(_blocked.get(limit.key, 0), at)
+            _requeue(item, at)
+            continue
+
+        try:
+            response = apihelper._get_req_session().request(item.method, item.url, **item.kwargs)
+        except Exception as e:
+            _finish(item, error=e)
+            continue
+
+        delay = retry_after(response)
+        item.attempts += 1
+        if delay and item.attempts <= MAX_RETRIES:
+            limit = item.limits[-1]  # the chat's bucket, or the bot's for chatless calls
+            try:
+                block(limit, delay)
+            except Exception as e:
+                print(f"[outbound.block] {e}")
+            _rewind(item.kwargs.get("files"))
+            with _cond:
+                _stats["retry_after"] += 1
+                _blocked[limit.key] = max(_blocked.get(limit.key, 0), time.time() + delay)
+            _requeue(item, time.time() + delay)
+            continue
+        _finish(item, result=response)
+
+
+def _ensure_workers():
+    with _cond:
+        while len(_workers) < settings.OUTBOUND_WORKERS:
+            t = Thread(target=_worker, name=f"outbound-{len(_workers)}", daemon=True)
+            _workers.append(t)
+            t.start()
+
+
+def _submit(item):
+    _ensure_workers()
+    deadline = time.time() + settings.OUTBOUND_MAX_WAIT
+    with _cond:
+        _pending.append(item)
+        _cond.notify_all()  # callers wait on the same condition
+        if item.detached:
+            return None
+        while not item.done:
+            left = deadline - time.time()
+            if left <= 0:
+                if item in _pending:
+                    _pending.remove(item)
+                else:
+                    item.detached = True  # a worker is sending it; let it report the outcome
+                _stats["timeouts"] += 1
+                raise OutboundTimeout(f"{item.url.rsplit('/', 1)[-1]}: not done within {settings.OUTBOUND_MAX_WAIT}s")
+            _cond.wait(left)
+    if item.error:
+        raise item.error
+    return item.result
+
+
+def _send_direct(method, url, kwargs):
+    for attempt in range(MAX_RETRIES + 1):
+        response = apihelper._get_req_session().request(method, url, **kwargs)
+        delay = retry_after(response)
+        if not delay or attempt == MAX_RETRIES or delay > settings.OUTBOUND_MAX_WAIT:
+            return response
+        with _cond:
+            _stats["retry_after"] += 1
+        _rewind(kwargs.get("files"))
+        time.sleep(delay)
+
+
+def send_request(method, url, **kwargs):
+    """apihelper.CUSTOM_REQUEST_SENDER: same signature and result as requests' request()."""
+    match = _URL.search(url)
+    if not match or not _QUEUED_METHOD.match(match.group(2)):
+        return _send_direct(method, url, kwargs)
+
+    bot_key = match.group(1).split(":")[0]  # the bot's id; keep tokens out of Redis
+    limits = [bot_limit(bot_key)]
+    chat_id = (kwargs.get("params") or {}).get("chat_id")
+    if chat_id is not None:
+        limits.append(chat_limit(bot_key, chat_id))
+    item = _Send(_priority.get(), method, url, kwargs, limits)
+    detach = _detach.get()
+    if detach is None:
+        return _submit(item)
+    _detach.set(None)  # only the call detached() wrapped
+    item.detached, item.on_sent = True, detach[0]
+    _submit(item)
+    raise _Detached()
+
+
+def detached(send, on_sent=None):
+    """
+    Run `send`, a bot call like `lambda: bot.reply_to(message, text)`, without
+    waiting for it. If its request is queued, returns None right away and
+    on_sent(message_id) runs on a worker once Telegram accepted it; otherwise
+    (queue off, unqueued method) it runs inline and its result is returned.
+    """
+    token = _detach.set([on_sent])
+    try:
+        result = send()
+    except _Detached:
+        return None
+    finally:
+        _detach.reset(token)
+    if on_sent and getattr(result, "message_id", None) is not None:
+        on_sent(result.message_id)
+    return result
+
+
+def install():
+    """Route every TeleBot in this process through the dispatcher."""
+    apihelper.CUSTOM_REQUEST_SENDER = send_request
+
+
+def metrics() -> dict:
+    """Queue depth and counters for this process."""
+    with _cond:
+        now = time.time()
+        depth = {name: 0 for name in PRIORITY_NAMES.values()}
+        for item in _pending:
+            depth[PRIORITY_NAMES[item.priority]] += 1
+        oldest = min((item.enqueued for item in _pending), default=now)
+        return {
+            "queued": depth,
+            "queued_total": len(_pending),
+            "inflight": _inflight,
+            "oldest_wait_seconds": round(now - oldest, 3),
+            "blocked_buckets": sum(1 for at in _blocked.values() if at > now),
+            "workers": len(_workers),
+            **_stats,
+        }
@@ -1,9 +1,44 @@
 # utils/redis_client.py
 import os
+import threading
 import redis
+from redis.client import Pipeline
 
 _redis = None
 
+# Per-thread count of Redis round trips (one per command, one per pipeline/MULTI).
+# Each update is handled on one thread, so the difference across an update is
+# what that update cost; see utils/update_context.py.
+_counter = threading.local()
+
+
+def round_trips() -> int:
+    """Redis round trips made by the current thread so far."""
+    return getattr(_counter, "n", 0)
+
+
+def _count():
+    _counter.n = getattr(_counter, "n", 0) + 1
+
+
+class _CountingPipeline(Pipeline):
+    def execute(self, raise_on_error=True):
+        if self.command_stack:
+            _count()
+        return super().execute(raise_on_error)
+
+
+class CountingRedis(redis.Redis):
+    """redis.Redis that counts round trips for round_trips()."""
+
+    def execute_command(self, *args, **options):
+        _count()
+        return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return _CountingPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
 def get_redis():
     """
     Return a process-wide Redis client (decode_responses=True).
@@ -15,7 +50,7 @@ def get_redis():
         port = int(os.getenv("REDIS_PORT", "6379"))
         db   = int(os.getenv("REDIS_DB", "0"))
         # sensible defaults for network hiccups in VPS/multiprocess setups
-        _redis = redis.Redis(
+        _redis = CountingRedis(
             host=host,
             port=port,
             db=db,
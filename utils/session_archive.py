@@ -0,0 +1,98 @@
+# utils/session_archive.py
+import json
+import zlib
+from datetime import datetime
+from bson import Binary
+from pymongo import ReplaceOne
+from utils.db import init_db
+
+# One document per finished session, instead of $push-ing every session into
+# a single LinksData document per (chat_id, bot_id) that grows toward the
+# 16 MB BSON limit and is rewritten on every push:
+#
+#   {bot_id, chat_id, ended_at, links, users, encoding: "zlib+json", data: <bytes>}
+#
+# data is the session's entry list (same dicts /end used to push), compressed.
+ARCHIVE = "session_archive"
+ENCODING = "zlib+json"
+
+
+def _pack(entries: list) -> Binary:
+    return Binary(zlib.compress(json.dumps(entries, separators=(",", ":")).encode()))
+
+
+def archive_session(db, bot_id: str, chat_id, entries: list, ended_at: datetime = None):
+    """Store one finished session. Cost is independent of the group's history."""
+    return db[ARCHIVE].insert_one({
+        "bot_id": bot_id,
+        "chat_id": int(chat_id),
+        "ended_at": ended_at or datetime.utcnow(),
+        "links": len(entries),
+        "users": len({e.get("user_id") for e in entries}),
+        "encoding": ENCODING,
+        "data": _pack(entries),
+    }).inserted_id
+
+
+def load_session_entries(doc: dict) -> list:
+    """Decode the entries of an archived session document."""
+    if doc.get("encoding") == ENCODING:
+        return json.loads(zlib.decompress(doc["data"]))
+    return doc.get("data", [])
+
+
+def list_archived_sessions(db, bot_id: str, chat_id, limit: int = 20) -> list:
+    """Latest archived sessions for a group, without their payload."""
+    return list(
+        db[ARCHIVE]
+        .find({"bot_id": bot_id, "chat_id": int(chat_id)}, {"data": 0})
+        .sort("ended_at", -1)
+        .limit(limit)
+    )
+
+
+def ensure_archive_indexes(db):
+    db[ARCHIVE].create_index(
+        [("bot_id", 1), ("chat_id", 1), ("ended_at", -1)],
+        name="archive_bot_chat_ended",
+    )
+    db[ARCHIVE].create_index([("ended_at", -1)], name="archive_ended")
+
+
+def migrate_links_data(db=None) -> int:
+    """
+    One-off: split every LinksData.data array into per-session archive docs.
+    Archive ids are derived from the source document and array position, so
+    re-running after an interruption never duplicates a session. The source
+    document is removed once all of its sessions are archived.
+    Returns the number of sessions archived.
+    """
+    db = db if db is not None else init_db()
+    total = 0
+    for doc in db["LinksData"].find({}):
+        sessions = doc.get("data") or []
+        # exact end times were never stored; the document's creation time is the best bound
+        ended_at = doc["_id"].generation_time.replace(tzinfo=None)
+        ops = [
+            ReplaceOne({"_id": f"{doc['_id']}:{i}"}, {
+                "bot_id": doc.get("bot_id"),
+                "chat_id": int(doc.get("chat_id")),
+                "ended_at": ended_at,
+                "links": len(entries or []),
+                "users": len({e.get("user_id") for e in entries or []}),
+                "encoding": ENCODING,
+                "data": _pack(entries or []),
+                "legacy_index": i,
+            }, upsert=True)
+            for i, entries in enumerate(sessions)
+        ]
+        if ops:
+            db[ARCHIVE].bulk_write(ops, ordered=False)
+        db["LinksData"].delete_one({"_id": doc["_id"]})
+        total += len(ops)
+    return total
+
+
+if __name__ == "__main__":
+    # one-off: python -m utils.session_archive
+    print(f"Archived {migrate_links_data()} session(s) from LinksData.")
@@ -0,0 +1,115 @@
+# utils/session_gc.py
+import time
+from config import settings
+from utils.db import init_db
+from utils.redis_client import get_redis
+from utils import session_store as store
+from utils.session_archive import archive_session, ARCHIVE
+from utils.session_persistence import scheduler
+
+_r = get_redis()
+
+# Sessions whose group never sent /end (bot kicked, admins gave up, ...) used
+# to stay in Redis forever. session_store.ACTIVITY_KEY scores every live group
+# with its last write time (stamped by the write-behind flusher), so idle ones
+# are a single ZRANGEBYSCORE away. Each sweep archives them like /end would,
+# then evicts their keys. Keys are only dropped once the archive insert
+# succeeded; a failed insert leaves the group in Redis for the next sweep.
+# Eviction re-checks that nothing was written since the entries were read; if
+# something was, the group is live again: its archive document is removed
+# and it stays.
+
+SWEEP_BATCH = 200
+
+
+def _seed_untracked_groups(now: float) -> int:
+    """Groups started before activity tracking existed get a full idle window from now."""
+    seeded = 0
+    for key in _r.scan_iter(match="session_groups:*"):
+        bot_id = key.split(":", 1)[1]
+        members = {store.dirty_member(bot_id, gid): now for gid in _r.smembers(key)}
+        if members:
+            seeded += _r.zadd(store.ACTIVITY_KEY, members, nx=True)
+    return seeded
+
+
+def sweep_idle_sessions(idle_ttl: int = None, batch: int = SWEEP_BATCH) -> dict:
+    """
+    Archive and evict sessions idle for more than `idle_ttl` seconds.
+    Returns {"sessions": n, "links": archived entries, "bytes": reclaimed Redis memory}.
+    """
+    idle_ttl = idle_ttl or settings.SESSION_IDLE_TTL
+    now = time.time()
+    _seed_untracked_groups(now)
+
+    report = {"sessions": 0, "links": 0, "bytes": 0}
+    idle = _r.zrangebyscore(store.ACTIVITY_KEY, "-inf", now - idle_ttl, start=0, num=batch)
+    for member in idle:
+        # ZREM is the claim: with several workers sweeping, only one gets each group
+        if not _r.zrem(store.ACTIVITY_KEY, member):
+            continue
+        if _r.sismember(store.DIRTY_KEY, member):
+            # written since the last flush, so not idle after all
+            _r.zadd(store.ACTIVITY_KEY, {member: now})
+            continue
+
+        bot_id, gid = member.split(":", 1)
+        try:
+            size = store.session_memory_usage(bot_id, gid)
+        except Exception:
+            size = 0  # MEMORY USAGE unsupported/disabled: still evict
+        archived = None
+        try:
+            entries = store.get_entries(bot_id, gid)
+            if entries:
+                archived = archive_session(init_db(), bot_id, gid, entries)
+        except Exception as e:
+            print(f"[session_gc.sweep] {member}: {e}")
+            _r.zadd(store.ACTIVITY_KEY, {member: now - idle_ttl})  # retry next sweep
+            continue
+        try:
+            evicted = store.stop_idle_session(bot_id, gid, len(entries))
+        except Exception as e:
+            # archived already: re-scoring would archive it a second time
+            print(f"[session_gc.sweep] {member}: archived but not evicted: {e}")
+            continue
+        if not evicted:
+            # written while we archived: still live, and a later /end or sweep archives it whole
+            if archived is not None:
+                init_db()[ARCHIVE].delete_one({"_id": archived})
+            _r.zadd(store.ACTIVITY_KEY, {member: now}, nx=True)
+            continue
+
+        report["sessions"] += 1
+        report["links"] += len(entries)
+        report["bytes"] += size
+    return report
+
+
+def _sweep_job():
+    try:
+        report = sweep_idle_sessions()
+        if report["sessions"]:
+            print(
+                f"[session_gc.sweep] evicted {report['sessions']} idle session(s), "
+                f"archived {report['links']} link(s), reclaimed {report['bytes']} bytes"
+            )
+    except Exception as e:
+        print(f"[session_gc.sweep] {e}")
+
+
+def start_session_sweeper(interval: int = None):
+    """Run the idle-session sweep on the session scheduler (idempotent)."""
+    if scheduler.get_job("session_sweep"):
+        return scheduler
+    scheduler.add_job(
+        _sweep_job,
+        "interval",
+        seconds=interval or settings.SESSION_SWEEP_INTERVAL,
+        id="session_sweep",
+        max_instances=1,
+        coalesce=True,
+    )
+    if not scheduler.running:
+        scheduler.start()
+    return scheduler
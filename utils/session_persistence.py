@@ -0,0 +1,126 @@
+# utils/session_persistence.py
+from datetime import datetime
+from apscheduler.schedulers.background import BackgroundScheduler
+from pymongo import ReplaceOne, DeleteOne
+from pymongo.errors import BulkWriteError
+from config import settings
+from utils.db import init_db
+from utils.redis_client import get_redis
+from utils import session_store as store
+
+_r = get_redis()
+
+# Write-behind copy of the live Redis sessions in MongoDB.
+#
+# Every session write adds "{bot_id}:{gid}" to session_store.DIRTY_KEY as part
+# of the same Redis call, so the webhook path pays nothing extra. A background
+# job pops dirty groups in batches, snapshots them in one MULTI and applies a
+# single unordered bulk_write: one document per group, however many writes it
+# saw since the last flush. Ended sessions are deleted from the collection.
+#
+# live_sessions document:
+#   {_id: "{bot_id}:{gid}", bot_id, chat_id, phase, entries (encoded, as in
+#    Redis), checked, sr, rev (Redis server time of the snapshot), updated_at}
+
+LIVE_SESSIONS = "live_sessions"
+FLUSH_BATCH = 500
+
+# present while Redis still holds the data it had before; missing after a
+# restart/flush/eviction, which is when sessions are rebuilt from MongoDB
+REDIS_EPOCH_KEY = "session_store:epoch"
+
+scheduler = BackgroundScheduler()
+
+
+def flush_dirty_sessions(batch: int = FLUSH_BATCH) -> int:
+    """Persist up to `batch` dirty groups to MongoDB. Returns how many were flushed."""
+    members = _r.spop(store.DIRTY_KEY, batch)
+    if not members:
+        return 0
+
+    try:
+        rev, snapshots = store.snapshot_groups(members)
+        ops, active, gone = [], [], []
+        for bot_id, gid, phase, raw_entries, checked, sr in snapshots:
+            _id = f"{bot_id}:{gid}"
+            # never let a slower flusher overwrite a newer snapshot
+            older = {"_id": _id, "$or": [{"rev": {"$lt": rev}}, {"rev": {"$exists": False}}]}
+            if phase is None and not raw_entries and not sr:
+                gone.append(_id)
+                ops.append(DeleteOne(older))
+            else:
+                active.append(_id)
+                ops.append(ReplaceOne(older, {
+                    "bot_id": bot_id,
+                    "chat_id": int(gid),
+                    "phase": phase,
+                    "entries": raw_entries,
+                    "checked": checked,
+                    "sr": sr,
+                    "rev": rev,
+                    "updated_at": datetime.utcnow(),
+                }, upsert=True))
+        # dirty == written since the last flush: that's the idle clock for the GC
+        store.record_activity(active, gone, rev / 1_000_000)
+        try:
+            init_db()[LIVE_SESSIONS].bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            # duplicate _id on upsert == a newer snapshot is already stored
+            real = [err for err in e.details.get("writeErrors", []) if err.get("code") != 11000]
+            if real:
+                raise
+    except Exception:
+        # put them back so the next run retries
+        _r.sadd(store.DIRTY_KEY, *members)
+        raise
+    return len(members)
+
+
+def _flush_job():
+    try:
+        while flush_dirty_sessions() == FLUSH_BATCH:
+            pass
+    except Exception as e:
+        print(f"[session_persistence.flush] {e}")
+
+
+def restore_sessions_from_mongo(force: bool = False) -> int:
+    """
+    Rebuild Redis session state from MongoDB after Redis lost its data.
+    Groups that still exist in Redis are left alone. Returns the number restored.
+    """
+    if not force and _r.exists(REDIS_EPOCH_KEY):
+        return 0
+
+    restored = 0
+    for doc in init_db()[LIVE_SESSIONS].find({}):
+        try:
+            if store.restore_group(
+                doc["bot_id"], doc["chat_id"], doc.get("phase"),
+                doc.get("entries", []), doc.get("checked", []), doc.get("sr", []),
+            ):
+                restored += 1
+        except Exception as e:
+            print(f"[session_persistence.restore] {doc.get('_id')}: {e}")
+
+    _r.set(REDIS_EPOCH_KEY, datetime.utcnow().isoformat())
+    if restored:
+        print(f"[session_persistence.restore] restored {restored} session(s) from MongoDB")
+    return restored
+
+
+def start_session_flusher(interval: float = None):
+    """Start the periodic write-behind flush for this process (idempotent)."""
+    if scheduler.get_job("session_flush"):
+        return scheduler
+    scheduler.add_job(
+        _flush_job,
+        "interval",
+        seconds=interval or settings.SESSION_FLUSH_INTERVAL,
+        id="session_flush",
+        max_instances=1,
+        coalesce=True,
+    )
+    if not scheduler.running:
+        scheduler.start()
+    return scheduler
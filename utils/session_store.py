@@ -0,0 +1,749 @@
+# utils/session_store.py
+import json
+import time
+import uuid
+import redis
+from utils.redis_client import get_redis
+
+_r = get_redis()
+
+# Per-(bot, group) session layout. Every key only holds one group's data, so
+# the cost of a message no longer depends on how many groups a bot serves.
+#
+#   session:{bot_id}:{gid}            hash  {"phase": collecting|verifying|closed}
+#   session:{bot_id}:{gid}:messages   list  encoded entries, entry N lives at index N-1
+#   session:{bot_id}:{gid}:checked    set   entry numbers marked as done
+#   session:{bot_id}:{gid}:sr         set   user ids asked for a screen recording
+#   session_groups:{bot_id}           set   gids that currently have a session
+#   session_dirty                     set   "{bot_id}:{gid}" changed since the last
+#                                           MongoDB flush (see utils/session_persistence.py)
+#   session_activity                  zset  "{bot_id}:{gid}" -> last write time, stamped by
+#                                           the flusher (see utils/session_gc.py)
+#
+# Secondary indexes, updated together with every write:
+#
+#   session:{bot_id}:{gid}:by_user    hash  user_id -> "1,5"  (entry numbers)
+#   session:{bot_id}:{gid}:by_x       hash  x_username -> "uid1,uid2"
+#   session:{bot_id}:{gid}:verified   set   user ids with at least one checked entry
+#
+# The old layout kept four JSON blobs (active_groups, group_messages,
+# sr_requested_users, unique_x_usernames) in the sessions:{bot_id} hash.
+# The first access to a bot moves those blobs over (see migrate_legacy_sessions);
+# other workers wait for that before touching the bot's sessions.
+#
+#   sessions:{bot_id}:migrating        hash  the legacy hash, renamed by the migrating worker
+#   sessions:{bot_id}:migrating:owner  str   its token, MIGRATE_LEASE_MS; expired = resume
+#   sessions:{bot_id}:migrating:done   set   gids already merged by this claim
+
+LEGACY_KEY = "sessions:{bot_id}"
+LEGACY_CLAIM_KEY = "sessions:{bot_id}:migrating"
+MIGRATE_LEASE_MS = 30_000
+MIGRATE_WAIT = 10  # seconds a caller waits for another worker's migration per attempt
+MIGRATE_POLL = 0.1
+
+# bots already checked for legacy data by this process
+_migrated_bots: set = set()
+
+
+def normalize_gid(group_id):
+    return str(group_id)
+
+
+def session_keys(bot_id: str, group_id) -> dict:
+    base = f"session:{bot_id}:{normalize_gid(group_id)}"
+    return {
+        "meta": base,
+        "messages": f"{base}:messages",
+        "checked": f"{base}:checked",
+        "sr": f"{base}:sr",
+        "by_user": f"{base}:by_user",
+        "by_x": f"{base}:by_x",
+        "verified": f"{base}:verified",
+    }
+
+
+def groups_key(bot_id: str) -> str:
+    return f"session_groups:{bot_id}"
+
+
+# every write adds its group here in the same call; the write-behind flusher drains it
+DIRTY_KEY = "session_dirty"
+
+
+def dirty_member(bot_id: str, group_id) -> str:
+    return f"{bot_id}:{normalize_gid(group_id)}"
+
+
+ACTIVITY_KEY = "session_activity"
+
+
+def record_activity(active: list, gone: list, at: float):
+    """Stamp groups that were written at `at` and forget the ones that ended."""
+    pipe = _r.pipeline(transaction=False)
+    if active:
+        pipe.zadd(ACTIVITY_KEY, {member: at for member in active})
+    if gone:
+        pipe.zrem(ACTIVITY_KEY, *gone)
+    pipe.execute()
+
+
+def session_memory_usage(bot_id: str, group_id) -> int:
+    """Bytes Redis uses for a group's session keys (MEMORY USAGE)."""
+    pipe = _r.pipeline(transaction=False)
+    for key in session_keys(bot_id, group_id).values():
+        pipe.memory_usage(key)
+    return sum(n or 0 for n in pipe.execute())
+
+
+def _ensure_migrated(bot_id: str):
+    """Bring the bot's data to the current layout the first time this process sees it."""
+    if bot_id in _migrated_bots:
+        return
+    deadline = time.monotonic() + MIGRATE_WAIT
+    try:
+        while migrate_legacy_sessions(bot_id) is None:
+            if time.monotonic() >= deadline:
+                # keep serving; what we write now is merged in when the migration finishes
+                print(f"[session_store.migrate] {bot_id}: still being migrated elsewhere")
+                return
+            time.sleep(MIGRATE_POLL)
+        legacy = LEGACY_KEY.format(bot_id=bot_id)
+        if not _r.exists(legacy, LEGACY_CLAIM_KEY.format(bot_id=bot_id)):
+            _migrated_bots.add(bot_id)
+    except Exception as e:
+        # keep serving; the next call in this process retries the migration
+        print(f"[session_store.migrate] {bot_id}: {e}")
+
+
+def _keys(bot_id: str, group_id) -> dict:
+    _ensure_migrated(bot_id)
+    return session_keys(bot_id, group_id)
+
+
+# Entry encoding. Entries are written as a fixed-position JSON array whose first
+# element is the schema version, instead of a dict that repeats every key:
+#
+#   v1: [1, user_id, username, first_name, x_username, link_tail]
+#
+# link_tail is what follows "https://x.com/{x_username}" in the link (the
+# x_username is taken from the link itself), or the full link if it doesn't
+# start with that prefix. "number" is the list position and "check" lives in
+# the checked set, so neither is stored. Entries written as JSON objects by
+# older code are still read as-is. Lua scripts read fields by position too.
+ENTRY_VERSION = 1
+_X_PREFIX = "https://x.com/"
+
+
+def _encode_entry(entry: dict) -> str:
+    x_username = entry.get("x_username")
+    link = entry.get("link") or ""
+    prefix = f"{_X_PREFIX}{x_username}"
+    link_tail = link[len(prefix):] if x_username and link.startswith(prefix) else link
+    return json.dumps(
+        [ENTRY_VERSION, entry.get("user_id"), entry.get("username"), entry.get("first_name"), x_username, link_tail],
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+
+
+def _decode_entry(raw: str, number: int, checked: set) -> dict:
+    data = json.loads(raw)
+    if isinstance(data, dict):
+        # written before the compact encoding
+        entry = {k: v for k, v in data.items() if k not in ("number", "check")}
+    elif data[0] == 1:
+        _, user_id, username, first_name, x_username, link_tail = data
+        link = link_tail if link_tail.startswith("http") else f"{_X_PREFIX}{x_username}{link_tail}"
+        entry = {
+            "user_id": user_id,
+            "username": username,
+            "first_name": first_name,
+            "link": link,
+            "x_username": x_username,
+        }
+    else:
+        raise ValueError(f"unknown session entry version: {data[0]}")
+    entry["number"] = number
+    entry["check"] = number in checked
+    return entry
+
+
+def _split_ids(raw) -> list:
+    return [int(x) for x in raw.split(",")] if raw else []
+
+
+# ---------------- Lifecycle ----------------
+# KEYS: dirty set, groups set, meta, then every other session key
+# ARGV: dirty member, gid
+# Returns 0 if the group already has a phase, 1 once a fresh session exists.
+_START_LUA = """
+if redis.call('HEXISTS', KEYS[3], 'phase') == 1 then
+    return 0
+end
+for i = 3, #KEYS do
+    redis.call('DEL', KEYS[i])
+end
+redis.call('HSET', KEYS[3], 'phase', 'collecting')
+redis.call('SADD', KEYS[2], ARGV[2])
+redis.call('SADD', KEYS[1], ARGV[1])
+return 1
+"""
+_start_script = _r.register_script(_START_LUA)
+
+
+def start_session(bot_id: str, group_id) -> bool:
+    """
+    Start a fresh session in one atomic round trip.
+    Returns False (and changes nothing) if the group already has a session.
+    """
+    keys = _keys(bot_id, group_id)
+    others = [k for name, k in keys.items() if name != "meta"]
+    return bool(_start_script(
+        keys=[DIRTY_KEY, groups_key(bot_id), keys["meta"], *others],
+        args=[dirty_member(bot_id, group_id), normalize_gid(group_id)],
+    ))
+
+
+def stop_session(bot_id: str, group_id) -> list:
+    """
+    Drop a group's session and return its entries (legacy dict format).
+    Reading the entries and deleting the keys happen in one MULTI/EXEC.
+    """
+    keys = _keys(bot_id, group_id)
+    pipe = _r.pipeline(transaction=True)
+    pipe.lrange(keys["messages"], 0, -1)
+    pipe.smembers(keys["checked"])
+    pipe.delete(*keys.values())
+    pipe.srem(groups_key(bot_id), normalize_gid(group_id))
+    pipe.sadd(DIRTY_KEY, dirty_member(bot_id, group_id))
+    raw_entries, checked, *_ = pipe.execute()
+    checked = {int(n) for n in checked}
+    return [_decode_entry(raw, i, checked) for i, raw in enumerate(raw_entries, start=1)]
+
+
+# KEYS: dirty set, activity zset, groups set, messages list, then every session key
+# ARGV: member, gid, entry count the caller archived
+_STOP_IDLE_LUA = """
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 1 or redis.call('ZSCORE', KEYS[2], ARGV[1]) then
+    return 0
+end
+if redis.call('LLEN', KEYS[4]) ~= tonumber(ARGV[3]) then return 0 end
+redis.call('DEL', unpack(KEYS, 5))
+redis.call('SREM', KEYS[3], ARGV[2])
+redis.call('SADD', KEYS[1], ARGV[1])
+return 1
+"""
+_stop_idle_script = _r.register_script(_STOP_IDLE_LUA)
+
+
+def stop_idle_session(bot_id: str, group_id, entry_count: int) -> bool:
+    """
+    Drop a session the caller already archived with `entry_count` entries,
+    unless it was written since (dirty, re-stamped in ACTIVITY_KEY, or a
+    different length). False = left alone.
+    """
+    keys = _keys(bot_id, group_id)
+    member = dirty_member(bot_id, group_id)
+    return bool(_stop_idle_script(
+        keys=[DIRTY_KEY, ACTIVITY_KEY, groups_key(bot_id), keys["messages"], *keys.values()],
+        args=[member, normalize_gid(group_id), entry_count],
+    ))
+
+
+def get_phase(bot_id: str, group_id):
+    return _r.hget(_keys(bot_id, group_id)["meta"], "phase")
+
+
+# KEYS: meta, groups set, dirty set
+# ARGV: phase, gid, dirty member, "1" to require an existing phase
+_SET_PHASE_LUA = """
+if ARGV[4] == '1' and redis.call('HEXISTS', KEYS[1], 'phase') == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'phase', ARGV[1])
+redis.call('SADD', KEYS[2], ARGV[2])
+redis.call('SADD', KEYS[3], ARGV[3])
+return 1
+"""
+_set_phase_script = _r.register_script(_SET_PHASE_LUA)
+
+
+def set_phase(bot_id: str, group_id, phase: str, only_if_active: bool = False) -> bool:
+    keys = _keys(bot_id, group_id)
+    return bool(_set_phase_script(
+        keys=[keys["meta"], groups_key(bot_id), DIRTY_KEY],
+        args=[phase, normalize_gid(group_id), dirty_member(bot_id, group_id),
+              "1" if only_if_active else "0"],
+    ))
+
+
+def list_session_groups(bot_id: str) -> list:
+    _ensure_migrated(bot_id)
+    return sorted(_r.smembers(groups_key(bot_id)))
+
+
+# ---------------- Entries ----------------
+def get_entries(bot_id: str, group_id) -> list:
+    keys = _keys(bot_id, group_id)
+    pipe = _r.pipeline(transaction=False)
+    pipe.lrange(keys["messages"], 0, -1)
+    pipe.smembers(keys["checked"])
+    raw_entries, checked = pipe.execute()
+    checked = {int(n) for n in checked}
+    return [_decode_entry(raw, i, checked) for i, raw in enumerate(raw_entries, start=1)]
+
+
+def get_entry(bot_id: str, group_id, number: int):
+    keys = _keys(bot_id, group_id)
+    pipe = _r.pipeline(transaction=False)
+    pipe.lindex(keys["messages"], number - 1)
+    pipe.sismember(keys["checked"], number)
+    raw, checked = pipe.execute()
+    if raw is None:
+        return None
+    return _decode_entry(raw, number, {number} if checked else set())
+
+
+# KEYS: messages, checked, by_user
+# ARGV: user_id
+# Returns flat {number, raw entry, checked(0/1), ...} for the user's entries.
+_USER_ENTRIES_LUA = """
+local out = {}
+local nums = redis.call('HGET', KEYS[3], ARGV[1])
+if not nums then return out end
+for n in string.gmatch(nums, '[^,]+') do
+    table.insert(out, tonumber(n))
+    table.insert(out, redis.call('LINDEX', KEYS[1], tonumber(n) - 1))
+    table.insert(out, redis.call('SISMEMBER', KEYS[2], n))
+end
+return out
+"""
+_user_entries_script = _r.register_script(_USER_ENTRIES_LUA)
+
+
+def get_user_entries(bot_id: str, group_id, user_id) -> list:
+    """A single user's entries via the by_user index (one round trip)."""
+    keys = _keys(bot_id, group_id)
+    flat = _user_entries_script(keys=[keys["messages"], keys["checked"], keys["by_user"]], args=[user_id])
+    entries = []
+    for i in range(0, len(flat), 3):
+        number = int(flat[i])
+        entries.append(_decode_entry(flat[i + 1], number, {number} if flat[i + 2] else set()))
+    return entries
+
+
+# KEYS: messages, by_user, by_x, dirty set
+# ARGV: user_id, x_username, encoded entry, dirty member
+_APPEND_LUA = """
+local number = redis.call('RPUSH', KEYS[1], ARGV[3])
+redis.call('SADD', KEYS[4], ARGV[4])
+local nums = redis.call('HGET', KEYS[2], ARGV[1])
+redis.call('HSET', KEYS[2], ARGV[1], nums and (nums .. ',' .. number) or tostring(number))
+local owners = redis.call('HGET', KEYS[3], ARGV[2])
+if not owners then
+    redis.call('HSET', KEYS[3], ARGV[2], ARGV[1])
+elseif not string.find(',' .. owners .. ',', ',' .. ARGV[1] .. ',', 1, true) then
+    redis.call('HSET', KEYS[3], ARGV[2], owners .. ',' .. ARGV[1])
+end
+return number
+"""
+_append_script = _r.register_script(_APPEND_LUA)
+
+
+def append_entry(bot_id: str, group_id, entry: dict) -> int:
+    """Append an entry without any checks and return its session number."""
+    keys = _keys(bot_id, group_id)
+    return _append_script(
+        keys=[keys["messages"], keys["by_user"], keys["by_x"], DIRTY_KEY],
+        args=[entry["user_id"], entry["x_username"], _encode_entry(entry), dirty_member(bot_id, group_id)],
+    )
+
+
+# KEYS: by_user, checked, verified, dirty set
+# ARGV: user_id, "1" to check / "0" to uncheck, dirty member
+# Returns {found(0/1), changed numbers...}
+_SET_USER_CHECKED_LUA = """
+local nums = redis.call('HGET', KEYS[1], ARGV[1])
+if not nums then return {0} end
+redis.call('SADD', KEYS[4], ARGV[3])
+local out = {1}
+for n in string.gmatch(nums, '[^,]+') do
+    local changed
+    if ARGV[2] == '1' then
+        changed = redis.call('SADD', KEYS[2], n)
+    else
+        changed = redis.call('SREM', KEYS[2], n)
+    end
+    if changed == 1 then table.insert(out, tonumber(n)) end
+end
+if ARGV[2] == '1' then
+    redis.call('SADD', KEYS[3], ARGV[1])
+else
+    redis.call('SREM', KEYS[3], ARGV[1])
+end
+return out
+"""
+_set_user_checked_script = _r.register_script(_SET_USER_CHECKED_LUA)
+
+
+def set_user_checked(bot_id: str, group_id, user_id, checked: bool = True):
+    """
+    Check or uncheck all of a user's entries.
+    Returns (found, changed_numbers); found is False if the user has no entries.
+    """
+    keys = _keys(bot_id, group_id)
+    out = _set_user_checked_script(
+        keys=[keys["by_user"], keys["checked"], keys["verified"], DIRTY_KEY],
+        args=[user_id, "1" if checked else "0", dirty_member(bot_id, group_id)],
+    )
+    return bool(out[0]), [int(n) for n in out[1:]]
+
+
+# ---------------- Link ingestion ----------------
+# Applies the per-user link limit, the duplicate-X-account check and the
+# append for one message in a single atomic call, so concurrent workers can't
+# lose each other's writes. Lookups go through the by_user / by_x indexes.
+#
+# KEYS: messages, by_user, by_x, dirty set
+# ARGV: user_id, limit, dirty member, then (x_username, encoded entry) pairs in message order
+# Returns one verdict per processed link:
+#   {"accepted", number} | {"limit"} | {"fraud", x_username, uid1, name1, ...}
+# Processing stops at the first "limit" verdict.
+_INGEST_LUA = """
+local user_id = ARGV[1]
+local limit = tonumber(ARGV[2])
+
+local function split(s)
+    local t = {}
+    if s then
+        for p in string.gmatch(s, '[^,]+') do table.insert(t, p) end
+    end
+    return t
+end
+
+local function first_name(uid)
+    local n = split(redis.call('HGET', KEYS[2], uid))[1]
+    if not n then return '' end
+    local e = cjson.decode(redis.call('LINDEX', KEYS[1], tonumber(n) - 1))
+    local name = e.first_name
+    if name == nil then name = e[4] end  -- v1 tuple: [1, uid, username, first_name, ...]
+    if type(name) == 'string' then return name end
+    return ''
+end
+
+local user_count = #split(redis.call('HGET', KEYS[2], user_id))
+local verdicts = {}
+local added = 0
+for i = 4, #ARGV, 2 do
+    local x_username = ARGV[i]
+    if user_count + added >= limit then
+        table.insert(verdicts, {'limit'})
+        break
+    end
+
+    local owners = redis.call('HGET', KEYS[3], x_username)
+    local owned = false
+    local others = {}
+    for _, uid in ipairs(split(owners)) do
+        if uid == user_id then
+            owned = true
+        else
+            table.insert(others, uid)
+            table.insert(others, first_name(uid))
+        end
+    end
+
+    if #others == 0 then
+        local number = redis.call('RPUSH', KEYS[1], ARGV[i + 1])
+        local nums = redis.call('HGET', KEYS[2], user_id)
+        redis.call('HSET', KEYS[2], user_id, nums and (nums .. ',' .. number) or tostring(number))
+        if not owned then
+            redis.call('HSET', KEYS[3], x_username, owners and (owners .. ',' .. user_id) or user_id)
+        end
+        redis.call('SADD', KEYS[4], ARGV[3])
+        added = added + 1
+        table.insert(verdicts, {'accepted', number})
+    else
+        local verdict = {'fraud', x_username}
+        for _, v in ipairs(others) do table.insert(verdict, v) end
+        table.insert(verdicts, verdict)
+    end
+end
+return verdicts
+"""
+_ingest_script = _r.register_script(_INGEST_LUA)
+
+
+def ingest_links(bot_id: str, group_id, user_id, entries: list, limit: int = 2) -> list:
+    """
+    Atomically store a user's links (one Redis round trip).
+    Returns a verdict per processed link, see _INGEST_LUA:
+    ("accepted", number), ("limit",) or ("fraud", x_username, [(uid, first_name), ...]).
+    """
+    keys = _keys(bot_id, group_id)
+    args = [user_id, limit, dirty_member(bot_id, group_id)]
+    for entry in entries:
+        args += [entry["x_username"], _encode_entry(entry)]
+
+    verdicts = []
+    for v in _ingest_script(keys=[keys["messages"], keys["by_user"], keys["by_x"], DIRTY_KEY], args=args):
+        if v[0] == "accepted":
+            verdicts.append(("accepted", int(v[1])))
+        elif v[0] == "fraud":
+            offenders = [(int(v[i]), v[i + 1]) for i in range(2, len(v), 2)]
+            verdicts.append(("fraud", v[1], offenders))
+        else:
+            verdicts.append(("limit",))
+    return verdicts
+
+
+def get_x_owners(bot_id: str, group_id, x_username: str) -> list:
+    """User ids that posted links for an X account in this session."""
+    return _split_ids(_r.hget(_keys(bot_id, group_id)["by_x"], x_username))
+
+
+def get_verified_user_ids(bot_id: str, group_id) -> set:
+    return {int(uid) for uid in _r.smembers(_keys(bot_id, group_id)["verified"])}
+
+
+def get_session_stats(bot_id: str, group_id) -> dict:
+    """
+    Session counters in one round trip. The indexes above are updated with
+    every write, and Redis keeps their lengths, so each count is O(1).
+    """
+    keys = _keys(bot_id, group_id)
+    pipe = _r.pipeline(transaction=False)
+    pipe.hlen(keys["by_user"])
+    pipe.llen(keys["messages"])
+    pipe.scard(keys["verified"])
+    pipe.scard(keys["sr"])
+    users, links, verified, sr = pipe.execute()
+    return {
+        "users": users,
+        "links": links,
+        "verified": verified,
+        "unsafe": users - verified,
+        "sr": sr,
+    }
+
+
+# ---------------- SR requests ----------------
+def add_sr_user(bot_id: str, group_id, user_id, pipe=None):
+    """Pass `pipe` to queue the write on a caller's pipeline instead of sending it."""
+    own = pipe is None
+    pipe = _r.pipeline(transaction=False) if own else pipe
+    pipe.sadd(_keys(bot_id, group_id)["sr"], user_id)
+    pipe.sadd(DIRTY_KEY, dirty_member(bot_id, group_id))
+    if own:
+        pipe.execute()
+
+
+def remove_sr_user(bot_id: str, group_id, user_id, pipe=None):
+    own = pipe is None
+    pipe = _r.pipeline(transaction=False) if own else pipe
+    pipe.srem(_keys(bot_id, group_id)["sr"], user_id)
+    pipe.sadd(DIRTY_KEY, dirty_member(bot_id, group_id))
+    if own:
+        pipe.execute()
+
+
+def get_sr_user_ids(bot_id: str, group_id) -> set:
+    return {int(uid) for uid in _r.smembers(_keys(bot_id, group_id)["sr"])}
+
+
+# ---------------- Migration ----------------
+def _write_indexes(pipe, keys: dict, entries: list, checked: set):
+    """Queue commands that rebuild the secondary indexes from raw entries."""
+    by_user, by_x, verified = {}, {}, set()
+    for number, e in enumerate(entries, start=1):
+        uid = str(e["user_id"])
+        by_user.setdefault(uid, []).append(str(number))
+        owners = by_x.setdefault(e["x_username"], [])
+        if uid not in owners:
+            owners.append(uid)
+        if number in checked:
+            verified.add(uid)
+
+    pipe.delete(keys["by_user"], keys["by_x"], keys["verified"])
+    if by_user:
+        pipe.hset(keys["by_user"], mapping={u: ",".join(n) for u, n in by_user.items()})
+    if by_x:
+        pipe.hset(keys["by_x"], mapping={x: ",".join(u) for x, u in by_x.items()})
+    if verified:
+        pipe.sadd(keys["verified"], *verified)
+
+
+def _write_group(pipe, bot_id: str, gid: str, phase, messages: list, sr_users: list):
+    keys = session_keys(bot_id, gid)
+    pipe.delete(*keys.values())
+    if phase:
+        pipe.hset(keys["meta"], "phase", phase)
+    checked = set()
+    if messages:
+        pipe.rpush(keys["messages"], *[_encode_entry(m) for m in messages])
+        checked = {i for i, m in enumerate(messages, start=1) if m.get("check")}
+        if checked:
+            pipe.sadd(keys["checked"], *checked)
+    if sr_users:
+        pipe.sadd(keys["sr"], *sr_users)
+    _write_indexes(pipe, keys, messages, checked)
+    pipe.sadd(groups_key(bot_id), gid)
+    pipe.sadd(DIRTY_KEY, dirty_member(bot_id, gid))
+
+
+def snapshot_groups(members: list):
+    """
+    Consistent raw state of several groups ("{bot_id}:{gid}" members) in one MULTI.
+    Returns (rev, [(bot_id, gid, phase, raw_entries, checked_numbers, sr_user_ids), ...])
+    where rev is the Redis server time in microseconds. phase is None and the
+    lists are empty once a session is gone.
+    """
+    pipe = _r.pipeline(transaction=True)
+    pipe.time()
+    parsed = []
+    for member in members:
+        bot_id, gid = member.split(":", 1)
+        keys = session_keys(bot_id, gid)
+        pipe.hget(keys["meta"], "phase")
+        pipe.lrange(keys["messages"], 0, -1)
+        pipe.smembers(keys["checked"])
+        pipe.smembers(keys["sr"])
+        parsed.append((bot_id, gid))
+    (seconds, micros), *results = pipe.execute()
+    snapshots = []
+    for i, (bot_id, gid) in enumerate(parsed):
+        phase, raw_entries, checked, sr = results[i * 4:i * 4 + 4]
+        snapshots.append((bot_id, gid, phase, raw_entries,
+                          sorted(int(n) for n in checked), sorted(int(u) for u in sr)))
+    return seconds * 1_000_000 + micros, snapshots
+
+
+def restore_group(bot_id: str, group_id, phase, raw_entries: list, checked: list, sr_users: list) -> bool:
+    """
+    Recreate a group's session from a snapshot (see snapshot_groups) unless
+    Redis already has one. Returns True if the group was restored.
+    """
+    gid = normalize_gid(group_id)
+    if _r.exists(*session_keys(bot_id, gid).values()):
+        return False
+    checked = set(checked)
+    messages = [_decode_entry(raw, i, checked) for i, raw in enumerate(raw_entries, start=1)]
+    pipe = _r.pipeline(transaction=True)
+    _write_group(pipe, bot_id, gid, phase, messages, sr_users)
+    pipe.execute()
+    return True
+
+
+# KEYS: legacy hash, claim hash, owner   ARGV: token, lease (ms)
+# 0: nothing to migrate, 1: claimed (fresh or a stale claim to resume),
+# -1: another worker holds a live claim
+_CLAIM_LUA = """
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    if redis.call('EXISTS', KEYS[1]) == 0 then return 0 end
+    redis.call('RENAME', KEYS[1], KEYS[2])
+end
+if redis.call('SET', KEYS[3], ARGV[1], 'NX', 'PX', ARGV[2]) then return 1 end
+return -1
+"""
+_claim_script = _r.register_script(_CLAIM_LUA)
+
+# KEYS: owner, then keys to delete when done   ARGV: token, lease (ms) or "done"
+_LEASE_LUA = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then return 0 end
+if ARGV[2] == 'done' then
+    redis.call('DEL', unpack(KEYS))
+else
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 1
+"""
+_lease_script = _r.register_script(_LEASE_LUA)
+
+
+def _merge_legacy_group(bot_id: str, gid: str, phase, messages: list, sr_users: list, done_key: str) -> bool:
+    """
+    Write one legacy group, merged in front of whatever the new layout already
+    holds for it (written by a worker that didn't wait for the migration).
+    Groups in done_key were merged by an earlier, interrupted run and are skipped.
+    """
+    keys = session_keys(bot_id, gid)
+    with _r.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                pipe.watch(done_key, *keys.values())
+                if pipe.sismember(done_key, gid):
+                    pipe.unwatch()
+                    return False
+                current_phase = pipe.hget(keys["meta"], "phase")
+                raw_entries = pipe.lrange(keys["messages"], 0, -1)
+                checked = {int(n) for n in pipe.smembers(keys["checked"])}
+                sr = pipe.smembers(keys["sr"])
+                current = [_decode_entry(raw, i, checked) for i, raw in enumerate(raw_entries, start=1)]
+                pipe.multi()
+                _write_group(
+                    pipe, bot_id, gid,
+                    current_phase or phase,
+                    list(messages) + current,
+                    {str(u) for u in sr_users} | sr,
+                )
+                pipe.sadd(done_key, gid)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                continue
+
+
+def migrate_legacy_sessions(bot_id: str):
+    """
+    Move a bot's sessions:{bot_id} blobs into the per-group layout.
+    The legacy hash is claimed with an atomic RENAME plus an owner lease, so
+    only one worker migrates it; a claim whose owner died (lease expired) is
+    resumed by the next worker that gets here.
+    Returns the number of groups migrated, or None while another worker holds
+    a live claim.
+    """
+    legacy = LEGACY_KEY.format(bot_id=bot_id)
+    claim = LEGACY_CLAIM_KEY.format(bot_id=bot_id)
+    owner, done_key = f"{claim}:owner", f"{claim}:done"
+    token = uuid.uuid4().hex
+    state = _claim_script(keys=[legacy, claim, owner], args=[token, MIGRATE_LEASE_MS])
+    if state == 0:
+        return 0
+    if state == -1:
+        return None
+
+    blobs = _r.hgetall(claim)
+    active_groups = json.loads(blobs.get("active_groups") or "{}")
+    group_messages = json.loads(blobs.get("group_messages") or "{}")
+    sr_requested = json.loads(blobs.get("sr_requested_users") or "{}")
+    unique_x = json.loads(blobs.get("unique_x_usernames") or "{}")
+
+    # unique_x_usernames is fully derivable from the messages (by_x index)
+    gids = set(active_groups) | set(group_messages) | set(sr_requested) | set(unique_x)
+    migrated = 0
+    for gid in gids:
+        if not _lease_script(keys=[owner], args=[token, MIGRATE_LEASE_MS]):
+            return None  # took too long and another worker resumed the claim
+        if _merge_legacy_group(
+            bot_id, gid,
+            active_groups.get(gid),
+            group_messages.get(gid, []),
+            sr_requested.get(gid, []),
+            done_key,
+        ):
+            migrated += 1
+
+    _lease_script(keys=[owner, claim, done_key], args=[token, "done"])
+    print(f"[session_store.migrate] {bot_id}: migrated {migrated} group session(s)")
+    return migrated
+
+
+def migrate_all_legacy_sessions() -> int:
+    """Migrate (or resume) every legacy sessions:{bot_id} hash found in Redis."""
+    bot_ids = {key.split(":")[1] for key in _r.scan_iter(match="sessions:*")}
+    return sum(migrate_legacy_sessions(bot_id) or 0 for bot_id in bot_ids)
+
+
+if __name__ == "__main__":
+    # one-off: python -m utils.session_store
+    print(f"Migrated {migrate_all_legacy_sessions()} group session(s).")
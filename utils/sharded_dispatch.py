@@ -0,0 +1,124 @@
+# utils/sharded_dispatch.py
+import bisect
+import contextvars
+import hashlib
+from concurrent.futures import Future
+from queue import Queue
+from threading import Thread, Lock
+from config import settings
+
+# Updates of one chat must be handled in order (link numbering, the two-link
+# limit, verification), different chats may run in parallel. Each shard is a
+# thread with its own queue; a chat always maps to the same shard through a
+# consistent-hash ring (VNODES points per shard), so one chat is serial while
+# other chats proceed on the other shards. A handler that blocks holds up the
+# other chats of its shard, which is why LOW-priority notices are sent
+# detached and queued sends wait at most OUTBOUND_MAX_WAIT (utils/outbound.py).
+#
+# DISPATCH_SHARDS=0 keeps dispatching inline on the calling thread.
+# Used by the child webhook (which waits for its update, so errors behave as
+# before) and by queued ingress (utils/ingress.py),
+# which acknowledges an entry once its shard has handled it.
+
+VNODES = 64
+SHARD_QUEUE_SIZE = 200  # beyond this submit() blocks, or raises queue.Full with block=False
+
+
+def _hash(key: str) -> int:
+    return int(hashlib.md5(key.encode()).hexdigest()[:8], 16)
+
+
+def update_chat_id(update):
+    """Chat an update belongs to, or None (inline queries, polls, ...)."""
+    for message in (update.message, update.edited_message, update.channel_post, update.edited_channel_post):
+        if message:
+            return message.chat.id
+    if update.callback_query and update.callback_query.message:
+        return update.callback_query.message.chat.id
+    for member in (update.chat_member, update.my_chat_member, update.chat_join_request):
+        if member:
+            return member.chat.id
+    return None
+
+
+class _Shard:
+    def __init__(self, index: int):
+        self.index = index
+        self.queue = Queue(maxsize=SHARD_QUEUE_SIZE)
+        self.busy = False
+        self.processed = 0
+        self.thread = Thread(target=self._run, name=f"shard-{index}", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            future, ctx, fn, args = self.queue.get()
+            self.busy = True
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(ctx.run(fn, *args))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                self.busy = False
+                self.processed += 1
+
+
+class ShardedDispatcher:
+    def __init__(self, shards: int, vnodes: int = VNODES):
+        self.shards = [_Shard(i) for i in range(shards)]
+        ring = sorted((_hash(f"shard-{i}:{v}"), i) for i in range(shards) for v in range(vnodes))
+        self._points = [p for p, _ in ring]
+        self._owners = [i for _, i in ring]
+
+    def shard_for(self, key: str) -> int:
+        i = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[i]
+
+    def submit(self, key: str, fn, *args, block: bool = True) -> Future:
+        """Run fn(*args) on key's shard, after everything queued there before. Context vars come along."""
+        future = Future()
+        self.shards[self.shard_for(key)].queue.put((future, contextvars.copy_context(), fn, args), block=block)
+        return future
+
+    def stats(self) -> dict:
+        return {
+            "shards": len(self.shards),
+            "queue_lengths": [s.queue.qsize() for s in self.shards],
+            "busy": [s.busy for s in self.shards],
+            "processed": [s.processed for s in self.shards],
+        }
+
+
+_dispatcher = None
+_lock = Lock()
+
+
+def get_dispatcher():
+    """Process-wide dispatcher, or None when DISPATCH_SHARDS=0."""
+    global _dispatcher
+    if _dispatcher is None and settings.DISPATCH_SHARDS > 0:
+        with _lock:
+            if _dispatcher is None:
+                _dispatcher = ShardedDispatcher(settings.DISPATCH_SHARDS)
+    return _dispatcher
+
+
+def shard_key(bot_id: str, update) -> str:
+    return f"{bot_id}:{update_chat_id(update)}"
+
+
+def dispatch(bot, bot_id: str, update, db_conn):
+    """manual_dispatch on the update's shard; waits for it and re-raises its errors."""
+    from utils.telegram import manual_dispatch  # utils.telegram imports the handlers
+
+    dispatcher = get_dispatcher()
+    if dispatcher is None:
+        return manual_dispatch(bot, bot_id, update, db_conn)
+    return dispatcher.submit(shard_key(bot_id, update), manual_dispatch, bot, bot_id, update, db_conn).result()
+
+
+def dispatch_stats() -> dict:
+    dispatcher = get_dispatcher()
+    return dispatcher.stats() if dispatcher else {"shards": 0, "queue_lengths": []}
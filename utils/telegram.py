@@ -1,48 +1,297 @@
-from threading import Lock
+import os
+import time
+import uuid
+from collections import OrderedDict
+from threading import Lock, Event, Thread
 from datetime import datetime, timedelta
 from telebot import apihelper
 import telebot.types
 import re
 from handlers.admin import notify_dev  # ✅ import notify_dev
-
-_admins_cache = {}
+from config import settings
+from utils.redis_client import get_redis
+from utils.update_context import update_context, memoized, update_memo
+from utils import outbound, http_pool
+
+_r = get_redis()
+
+# Admin cache, two tiers, keyed per bot and chat:
+#   admins:{bot_id}:{chat_id}   Redis set of admin user ids, ADMIN_CACHE_TTL;
+#                               shared by every worker, so one
+#                               getChatAdministrators call serves them all
+#   _admins_lru                 small in-process LRU in front of it
+# A chat with no admins is cached as the single member NO_ADMINS.
+#
+# Every write to the Redis set publishes "{bot_id}:{chat_id}" on
+# ADMINS_CHANNEL; each process listens and drops that chat from its LRU, so a
+# promotion/demotion seen by one worker reaches the others right away. The
+# LRU is only used while the subscription is up and is emptied whenever it
+# drops (changes may have been missed); ADMIN_LRU_TTL is the backstop.
+ADMIN_LRU_SIZE = 1024
+ADMIN_LRU_TTL = 30
+ADMINS_CHANNEL = "admins_changed"
+NO_ADMINS = "0"
+
+_admins_lru = OrderedDict()  # (bot_id, gid) -> (expires_at, frozenset)
 _lock = Lock()
+_subscribed = Event()
+_listener_pid = None
+_invalidations = 0  # bumped per drop; a read that raced one doesn't fill the LRU
 
 def normalize_gid(chat_id):
     return str(chat_id)
 
-def get_cached_admins(chat_id):
-    gid = normalize_gid(chat_id)
-    with _lock:
-        return _admins_cache.get(gid)
+def _admins_key(bot_id, chat_id):
+    return f"admins:{bot_id or 'default'}:{normalize_gid(chat_id)}"
 
-def set_cached_admins(chat_id, admin_ids):
-    gid = normalize_gid(chat_id)
+def _admins_member(bot_id, chat_id):
+    return f"{bot_id or 'default'}:{normalize_gid(chat_id)}"
+
+def _lru_drop(member):
+    global _invalidations
+    bot_id, gid = member.split(":", 1)
     with _lock:
-        _admins_cache[gid] = admin_ids
+        _invalidations += 1
+        _admins_lru.pop((bot_id, gid), None)
+        if bot_id == "default":
+            _admins_lru.pop((None, gid), None)
 
-def clear_cached_admins(chat_id):
-    gid = normalize_gid(chat_id)
+def _lru_clear():
+    global _invalidations
     with _lock:
-        _admins_cache.pop(gid, None)
+        _invalidations += 1
+        _admins_lru.clear()
 
-def is_user_admin_cached(chat_id, user_id):
-    gid = normalize_gid(chat_id)
+def _listen_admin_changes():
+    while True:
+        pubsub = _r.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(ADMINS_CHANNEL)
+            _subscribed.set()
+            while True:
+                msg = pubsub.get_message(timeout=1.0)
+                if msg and msg["type"] == "message":
+                    _lru_drop(msg["data"])
+        except Exception as e:
+            print(f"[telegram.admins_listener] {e}")
+        finally:
+            _subscribed.clear()
+            _lru_clear()  # changes published while we weren't listening are lost
+            try:
+                pubsub.close()
+            except Exception:
+                pass
+        time.sleep(1)
+
+def _ensure_listener():
+    """Start this process's invalidation listener (again after a fork)."""
+    global _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    with _lock:
+        if _listener_pid == os.getpid():
+            return
+        _listener_pid = os.getpid()
+        _subscribed.clear()
+    _lru_clear()  # inherited from the parent, never invalidated here
+    Thread(target=_listen_admin_changes, name="admins-listener", daemon=True).start()
+
+def _lru_put(lru_key, admin_ids, seen):
+    _ensure_listener()
+    if not _subscribed.is_set():
+        return
     with _lock:
-        admins = _admins_cache.get(gid)
-        if admins is None:
-            return None  # Not cached yet
-        return user_id in admins
+        if _invalidations != seen:
+            return
+        _admins_lru[lru_key] = (time.monotonic() + ADMIN_LRU_TTL, admin_ids)
+        _admins_lru.move_to_end(lru_key)
+        while len(_admins_lru) > ADMIN_LRU_SIZE:
+            _admins_lru.popitem(last=False)
+
+def get_cached_admins(chat_id, bot_id=None):
+    """Cached admin ids (frozenset) for the chat, or None if not cached."""
+    lru_key = (bot_id, normalize_gid(chat_id))
+    if _subscribed.is_set():
+        with _lock:
+            hit = _admins_lru.get(lru_key)
+            if hit and hit[0] > time.monotonic():
+                _admins_lru.move_to_end(lru_key)
+                return hit[1]
+
+    seen = _invalidations
+    members = _r.smembers(_admins_key(bot_id, chat_id))
+    if not members:
+        return None
+    admin_ids = frozenset(int(uid) for uid in members if uid != NO_ADMINS)
+    _lru_put(lru_key, admin_ids, seen)
+    return admin_ids
+
+def set_cached_admins(chat_id, admin_ids, bot_id=None):
+    admin_ids = frozenset(int(uid) for uid in admin_ids)
+    key = _admins_key(bot_id, chat_id)
+    seen = _invalidations
+    pipe = _r.pipeline(transaction=True)
+    pipe.delete(key)
+    pipe.sadd(key, *(admin_ids or [NO_ADMINS]))
+    pipe.expire(key, settings.ADMIN_CACHE_TTL)
+    pipe.publish(ADMINS_CHANNEL, _admins_member(bot_id, chat_id))
+    pipe.execute()
+    _lru_put((bot_id, normalize_gid(chat_id)), admin_ids, seen)
+    update_memo(("admins", bot_id, normalize_gid(chat_id)), lambda _: admin_ids)
+
+def clear_cached_admins(chat_id, bot_id=None):
+    pipe = _r.pipeline(transaction=True)
+    pipe.delete(_admins_key(bot_id, chat_id))
+    pipe.publish(ADMINS_CHANNEL, _admins_member(bot_id, chat_id))
+    pipe.execute()
+    _lru_drop(_admins_member(bot_id, chat_id))
+
+def is_user_admin_cached(chat_id, user_id, bot_id=None):
+    admins = get_cached_admins(chat_id, bot_id)
+    if admins is None:
+        return None  # Not cached yet
+    return user_id in admins
+
+def refresh_admins(bot, chat_id, bot_id=None):
+    """Fetch the admin list from Telegram and replace the cached one (raises on API errors)."""
+    admins = bot.get_chat_administrators(chat_id)
+    admin_ids = frozenset(admin.user.id for admin in admins)
+    set_cached_admins(chat_id, admin_ids, bot_id=bot_id)
+    return admin_ids
+
+# Single-flight for cache misses: when a session starts, many users post at
+# once and every worker would call getChatAdministrators for the same chat.
+# Within a process, one thread fetches and the others wait on its Event;
+# across processes, the fetcher holds admins_lock:{bot_id}:{chat_id}
+# (SET NX PX) and the others poll the shared cache until it is filled.
+ADMIN_FETCH_LOCK_MS = 5000
+ADMIN_FETCH_POLL = 0.05
+
+class _Flight:
+    def __init__(self):
+        self.done = Event()
+        self.admin_ids = None
+
+_flights = {}  # (bot_id, gid) -> _Flight
+
+_RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end
+return 0
+"""
+_release_script = _r.register_script(_RELEASE_LUA)
+
+def _fetch_admins_shared(bot, chat_id, bot_id):
+    """Fetch under the cross-process lock, or wait for whoever holds it."""
+    lock_key = f"admins_lock:{bot_id or 'default'}:{normalize_gid(chat_id)}"
+    deadline = time.monotonic() + ADMIN_FETCH_LOCK_MS / 1000
+    while True:
+        token = uuid.uuid4().hex
+        if _r.set(lock_key, token, nx=True, px=ADMIN_FETCH_LOCK_MS):
+            try:
+                # filled while we were acquiring the lock?
+                admin_ids = get_cached_admins(chat_id, bot_id)
+                if admin_ids is None:
+                    admin_ids = refresh_admins(bot, chat_id, bot_id=bot_id)
+                return admin_ids
+            finally:
+                _release_script(keys=[lock_key], args=[token])
+
+        # another process is fetching: wait for its result
+        while _r.exists(lock_key) and time.monotonic() < deadline:
+            time.sleep(ADMIN_FETCH_POLL)
+            admin_ids = get_cached_admins(chat_id, bot_id)
+            if admin_ids is not None:
+                return admin_ids
+        admin_ids = get_cached_admins(chat_id, bot_id)
+        if admin_ids is not None:
+            return admin_ids
+        if time.monotonic() >= deadline:
+            # holder is stuck; don't leave the user waiting any longer
+            return refresh_admins(bot, chat_id, bot_id=bot_id)
+        # holder failed without filling the cache: try to take over
+
+def load_admins(bot, chat_id, bot_id=None):
+    """Cached admin ids, fetching them once per chat however many callers miss at the same time."""
+    admin_ids = get_cached_admins(chat_id, bot_id)
+    if admin_ids is not None:
+        return admin_ids
+
+    flight_key = (bot_id, normalize_gid(chat_id))
+    with _lock:
+        flight = _flights.get(flight_key)
+        leader = flight is None
+        if leader:
+            flight = _flights[flight_key] = _Flight()
+
+    if not leader:
+        flight.done.wait(ADMIN_FETCH_LOCK_MS / 1000)
+        if flight.admin_ids is not None:
+            return flight.admin_ids
+        return _fetch_admins_shared(bot, chat_id, bot_id)  # leader failed
+
+    try:
+        flight.admin_ids = _fetch_admins_shared(bot, chat_id, bot_id)
+        return flight.admin_ids
+    finally:
+        with _lock:
+            _flights.pop(flight_key, None)
+        flight.done.set()
+
+# Promotions/demotions arrive as chat_member updates (my_chat_member for the
+# bot itself) and patch the cached set in place, so admin checks don't
+# depend on the cache expiring. Chats not cached are left alone; the next
+# miss fetches a fresh list anyway.
+ADMIN_STATUSES = ("creator", "administrator")
+
+# KEYS: admins set   ARGV: user_id, "1" promote | "0" demote, NO_ADMINS, channel, member
+_PATCH_ADMINS_LUA = """
+local ttl = redis.call('PTTL', KEYS[1])
+if ttl == -2 then return 0 end
+if ARGV[2] == '1' then
+    redis.call('SADD', KEYS[1], ARGV[1])
+    redis.call('SREM', KEYS[1], ARGV[3])
+else
+    redis.call('SREM', KEYS[1], ARGV[1])
+    if redis.call('SCARD', KEYS[1]) == 0 then redis.call('SADD', KEYS[1], ARGV[3]) end
+end
+if ttl > 0 then redis.call('PEXPIRE', KEYS[1], ttl) end
+redis.call('PUBLISH', ARGV[4], ARGV[5])
+return 1
+"""
+_patch_admins_script = _r.register_script(_PATCH_ADMINS_LUA)
+
+def apply_chat_member_update(bot_id, member_update, own: bool = False):
+    """Patch the cached admins of a chat from a ChatMemberUpdated (own: my_chat_member)."""
+    chat_id = member_update.chat.id
+    user_id = member_update.new_chat_member.user.id
+    status = member_update.new_chat_member.status
+    is_admin = status in ADMIN_STATUSES
+    was_admin = member_update.old_chat_member.status in ADMIN_STATUSES
+
+    if own and status in ("left", "kicked"):
+        clear_cached_admins(chat_id, bot_id=bot_id)  # we're out of the chat
+        return
+    if is_admin == was_admin:
+        return  # rights edited, member joined/left/restricted: admin set unchanged
+
+    member = _admins_member(bot_id, chat_id)
+    _patch_admins_script(
+        keys=[_admins_key(bot_id, chat_id)],
+        args=[user_id, "1" if is_admin else "0", NO_ADMINS, ADMINS_CHANNEL, member],
+    )
+    _lru_drop(member)  # the next read takes the patched set from Redis
+    patch = (lambda ids: ids | {user_id}) if is_admin else (lambda ids: ids - {user_id})
+    update_memo(("admins", bot_id, normalize_gid(chat_id)), lambda ids: None if ids is None else patch(ids))
 
-def is_user_admin(bot, chat_id, user_id):
-    cached_result = is_user_admin_cached(chat_id, user_id)
-    if cached_result is not None:
-        return cached_result
+def is_user_admin(bot, chat_id, user_id, bot_id=None):
+    key = ("admins", bot_id, normalize_gid(chat_id))
+    cached_admins = memoized(key, lambda: get_cached_admins(chat_id, bot_id))
+    if cached_admins is not None:
+        return user_id in cached_admins
 
     try:
-        admins = bot.get_chat_administrators(chat_id)
-        admin_ids = [admin.user.id for admin in admins]
-        set_cached_admins(chat_id, admin_ids)
+        admin_ids = load_admins(bot, chat_id, bot_id=bot_id)
+        update_memo(key, lambda _: admin_ids)
         return user_id in admin_ids
     except Exception as e:
         # ✅ Notify dev
@@ -50,8 +299,9 @@ def is_user_admin(bot, chat_id, user_id):
         notify_dev(bot, e, context, message=None)
         return False
 
-def mute_user(bot, chat_id, user_id, duration=timedelta(days=3)):
-    until_date = datetime.utcnow() + duration
+def mute_user(bot, chat_id, user_id, duration=timedelta(days=3), until_date=None, notify=True):
+    """notify=False: just report failure (bulk callers summarize failures themselves)."""
+    until_date = until_date or datetime.utcnow() + duration
     permissions = telebot.types.ChatPermissions(
         can_send_messages=False,
         can_send_media_messages=False,
@@ -70,10 +320,16 @@ def mute_user(bot, chat_id, user_id, duration=timedelta(days=3)):
     except apihelper.ApiTelegramException as e:
         # ✅ Notify dev
         context = "mute_user"
-        notify_dev(bot, e, context)
+        if notify:
+            notify_dev(bot, e, context)
+        else:
+            print(f"[{context}] {chat_id}/{user_id}: {e}")
         return False
     except Exception as e:
-        notify_dev(bot, e, "mute_user_general")
+        if notify:
+            notify_dev(bot, e, "mute_user_general")
+        else:
+            print(f"[mute_user_general] {chat_id}/{user_id}: {e}")
         return False
 
 def parse_duration(duration_str):
@@ -103,10 +359,23 @@ from utils.message_tracker import track_message
 from utils.group_manager import get_allowed_groups, save_group_metadata
 
 def manual_dispatch(bot, bot_id: str, update, db_conn):
+    # one context per update: memoized reads + deferred writes (utils/update_context.py)
+    with update_context(bot_id, update.update_id):
+        _dispatch(bot, bot_id, update, db_conn)
+
+def _dispatch(bot, bot_id: str, update, db_conn):
     if update.callback_query:
         callbacks.handle_callback(bot, bot_id, update.callback_query)
         return
 
+    # promotions/demotions keep the admin cache current
+    if update.chat_member:
+        apply_chat_member_update(bot_id, update.chat_member)
+        return
+    if update.my_chat_member:
+        apply_chat_member_update(bot_id, update.my_chat_member, own=True)
+        return
+
     if not update.message:
         return
 
@@ -122,7 +391,8 @@ def manual_dispatch(bot, bot_id: str, update, db_conn):
     # PRIVATE: commands come from textual messages (most common). If no text, still pass to handler
     if chat.type == "private":
         if incoming_text.startswith("/"):
-            commands.handle_command(bot, bot_id, message, db_conn)
+            with outbound.priority(outbound.HIGH):
+                commands.handle_command(bot, bot_id, message, db_conn)
         else:
             text_handler.handle_text(bot, bot_id, message, db_conn)
         return
@@ -135,17 +405,23 @@ def manual_dispatch(bot, bot_id: str, update, db_conn):
             return
 
         # command detection: only true text messages start with "/"
+        # (command replies jump the send queue; link/limit/fraud notices wait behind them)
         if incoming_text.startswith("/"):
-            commands.handle_group_command(bot, bot_id, message, db_conn)
+            with outbound.priority(outbound.HIGH):
+                commands.handle_group_command(bot, bot_id, message, db_conn)
         else:
             # non-command messages (including media captions) go to group text handler
-            text_handler.handle_group_text(bot, bot_id, message, db_conn)
+            with outbound.priority(outbound.LOW):
+                text_handler.handle_group_text(bot, bot_id, message, db_conn)
 
 from telebot import TeleBot
 from typing import Dict, Optional
-from utils import db
+from utils import db, ingress
 from config import settings
 
+# chat_member is only delivered when asked for explicitly
+ALLOWED_UPDATES = ["message", "callback_query", "chat_member", "my_chat_member"]
+
 class BotManager:
     """
     Holds the admin bot + all child bots.
@@ -182,7 +458,8 @@ class BotManager:
             return False
         try:
             bot.remove_webhook()
-            bot.set_webhook(url)
+            bot.set_webhook(url, allowed_updates=ALLOWED_UPDATES, secret_token=settings.INGRESS_SECRET or None)
+            ingress.mark_secured(bot_id)
             db.set_bot_webhook(bot_id, url)
             return True
         except Exception as e:
@@ -197,8 +474,12 @@ class BotManager:
                 bot.remove_webhook()
             except Exception:
                 pass
+        ingress.unmark_secured(bot_id)
         db.set_bot_webhook(bot_id, None)
 
 
 # Instantiate manager
+http_pool.install()
+if settings.OUTBOUND_QUEUE:
+    outbound.install()
 manager = BotManager()
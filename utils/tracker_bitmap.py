@@ -0,0 +1,139 @@
+# utils/tracker_bitmap.py
+from utils.redis_client import get_redis
+
+_r = get_redis()
+
+# Compact encoding for tracked message ids (TRACKER_ENCODING=bitmap).
+#
+# Message ids in a chat are dense increasing integers, so instead of one
+# sorted-set member (plus score) per id, ids are stored as bits in fixed-size
+# chunks:
+#
+#   trackbits:{bot_id}:{chat_id}      hash  chunk number -> CHUNK_BYTES bitmap
+#                                           (id = chunk * CHUNK_BITS + bit, LSB first)
+#   trackbits_idx:{bot_id}:{chat_id}  zset  chunk number -> last time an id was
+#                                           tracked in it
+#
+# Values stay under 64 bytes so the hash keeps Redis' compact listpack/ziplist
+# encoding. Age is tracked per chunk, not per id: a chunk counts as recent
+# while any of its ids is, so age-window clears may include a few older ids
+# from the same chunk but never skip a deletable one.
+#
+# Only utils.message_tracker should call this module.
+
+CHUNK_BITS = 256
+CHUNK_BYTES = CHUNK_BITS // 8
+
+# shared Lua: POW[k + 1] == 2^k, and stale-chunk trimming
+_LUA_PRELUDE = """
+local POW = {1, 2, 4, 8, 16, 32, 64, 128}
+local function trim(hash, idx, stale_before)
+    local old = redis.call('ZRANGEBYSCORE', idx, '-inf', '(' .. stale_before)
+    for _, chunk in ipairs(old) do redis.call('HDEL', hash, chunk) end
+    if #old > 0 then redis.call('ZREM', idx, unpack(old)) end
+end
+"""
+
+# KEYS: hash, idx   ARGV: ttl, stale_before, then (message_id, tracked_at) pairs
+_WRITE_LUA = _LUA_PRELUDE + """
+local newest = {}
+for i = 3, #ARGV, 2 do
+    local mid = tonumber(ARGV[i])
+    local chunk = tostring(math.floor(mid / %(bits)d))
+    local off = mid %% %(bits)d
+    local pos = math.floor(off / 8) + 1
+    local mask = POW[off %% 8 + 1]
+    local bm = redis.call('HGET', KEYS[1], chunk) or string.rep('\\0', %(bytes)d)
+    local b = string.byte(bm, pos)
+    if math.floor(b / mask) %% 2 == 0 then
+        bm = string.sub(bm, 1, pos - 1) .. string.char(b + mask) .. string.sub(bm, pos + 1)
+        redis.call('HSET', KEYS[1], chunk, bm)
+    end
+    local ts = tonumber(ARGV[i + 1])
+    if not newest[chunk] or newest[chunk] < ts then newest[chunk] = ts end
+end
+for chunk, ts in pairs(newest) do redis.call('ZADD', KEYS[2], ts, chunk) end
+trim(KEYS[1], KEYS[2], ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+""" % {"bits": CHUNK_BITS, "bytes": CHUNK_BYTES}
+
+# KEYS: hash, idx[, job hash]   ARGV: oldest score, stale_before, batch size
+_POP_LUA = _LUA_PRELUDE + """
+trim(KEYS[1], KEYS[2], ARGV[2])
+local limit = tonumber(ARGV[3])
+local ids = {}
+for _, chunk in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], ARGV[1], '+inf')) do
+    local bm = redis.call('HGET', KEYS[1], chunk)
+    if bm then
+        local base = tonumber(chunk) * %(bits)d
+        local bytes = {string.byte(bm, 1, -1)}
+        local left = 0
+        for pos = 1, #bytes do
+            local b = bytes[pos]
+            for k = 0, 7 do
+                if #ids >= limit then break end
+                if math.floor(b / POW[k + 1]) %% 2 == 1 then
+                    table.insert(ids, base + (pos - 1) * 8 + k)
+                    bytes[pos] = bytes[pos] - POW[k + 1]
+                end
+            end
+            left = left + bytes[pos]
+        end
+        if left == 0 then
+            redis.call('HDEL', KEYS[1], chunk)
+            redis.call('ZREM', KEYS[2], chunk)
+        else
+            redis.call('HSET', KEYS[1], chunk, string.char(unpack(bytes)))
+        end
+    else
+        redis.call('ZREM', KEYS[2], chunk)
+    end
+    if #ids >= limit then break end
+end
+if #ids > 0 and KEYS[3] then
+    redis.call('HSET', KEYS[3], 'inflight', table.concat(ids, ','))
+end
+return ids
+""" % {"bits": CHUNK_BITS}
+
+# KEYS: hash, idx   ARGV: oldest score
+_COUNT_LUA = _LUA_PRELUDE + """
+local n = 0
+for _, chunk in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], ARGV[1], '+inf')) do
+    local bm = redis.call('HGET', KEYS[1], chunk)
+    if bm then
+        for _, b in ipairs({string.byte(bm, 1, -1)}) do
+            for k = 1, 8 do
+                if math.floor(b / POW[k]) % 2 == 1 then n = n + 1 end
+            end
+        end
+    end
+end
+return n
+"""
+
+_pop_script = _r.register_script(_POP_LUA)
+
+
+def bitmap_keys(bot_id: str, chat_id: int) -> list:
+    return [f"trackbits:{bot_id}:{chat_id}", f"trackbits_idx:{bot_id}:{chat_id}"]
+
+
+def write(pipe, bot_id: str, chat_id: int, ids: dict, ttl: int, stale_before: float):
+    """Queue setting the bits for {message_id: tracked_at} on `pipe`."""
+    args = [ttl, stale_before]
+    for mid, ts in ids.items():
+        args += [int(mid), ts]
+    # plain EVAL: an EVALSHA on a pipeline costs an extra SCRIPT EXISTS round trip
+    pipe.eval(_WRITE_LUA, 2, *bitmap_keys(bot_id, chat_id), *args)
+
+
+def pop_batch(bot_id: str, chat_id: int, oldest: float, stale_before: float, batch: int, job_hash: str = None) -> list:
+    keys = bitmap_keys(bot_id, chat_id) + ([job_hash] if job_hash else [])
+    return _pop_script(keys=keys, args=[oldest, stale_before, batch])
+
+
+def count(pipe, bot_id: str, chat_id: int, oldest: float):
+    """Queue counting the ids tracked since `oldest` on `pipe`."""
+    pipe.eval(_COUNT_LUA, 2, *bitmap_keys(bot_id, chat_id), oldest)
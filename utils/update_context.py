@@ -0,0 +1,115 @@
+# utils/update_context.py
+from contextlib import contextmanager
+from contextvars import ContextVar
+from config import settings
+from utils.redis_client import get_redis, round_trips
+
+# One UpdateContext lives for the duration of a single Telegram update
+# (opened by utils.telegram.manual_dispatch). Handlers don't receive it as an
+# argument: the helpers below find it through a ContextVar and fall back to
+# plain Redis calls when there is none (scripts, background jobs).
+#
+#   memoized(key, load)  -> same read twice in one update hits Redis once
+#   update_memo(key, fn) -> keep a memoized value in step with a local write
+#   forget(key)          -> drop it after a write whose result isn't known
+#   defer_write(fn)      -> fn(pipe) queued; all run in one pipeline at the end
+#   deferred_batch(name, write) -> dict shared by every caller in the update,
+#                           written once by write(pipe, batch) at the end
+
+_current = ContextVar("update_context", default=None)
+
+
+class UpdateContext:
+    def __init__(self, bot_id: str, update_id=None):
+        self.bot_id = bot_id
+        self.update_id = update_id
+        self.memo_hits = 0
+        self.round_trips = 0
+        self._memo = {}
+        self._deferred = []
+        self._batches = {}
+        self._start = round_trips()
+
+    def memo(self, key, load):
+        if key in self._memo:
+            self.memo_hits += 1
+            return self._memo[key]
+        value = self._memo[key] = load()
+        return value
+
+    def flush(self):
+        """Run every deferred write in a single non-transactional pipeline."""
+        writes, self._deferred = self._deferred, []
+        if writes:
+            pipe = get_redis().pipeline(transaction=False)
+            for write in writes:
+                write(pipe)
+            pipe.execute()
+        self.round_trips = round_trips() - self._start
+
+
+def current():
+    return _current.get()
+
+
+@contextmanager
+def update_context(bot_id: str, update_id=None):
+    ctx = UpdateContext(bot_id, update_id)
+    token = _current.set(ctx)
+    try:
+        yield ctx
+    finally:
+        _current.reset(token)
+        try:
+            ctx.flush()
+        except Exception as e:
+            print(f"[update_context.flush] {e}")
+        if settings.UPDATE_STATS:
+            print(
+                f"[update] bot={bot_id} update={update_id} "
+                f"redis_round_trips={ctx.round_trips} memo_hits={ctx.memo_hits}"
+            )
+
+
+def memoized(key, load):
+    ctx = _current.get()
+    return ctx.memo(key, load) if ctx else load()
+
+
+def update_memo(key, fn):
+    ctx = _current.get()
+    if ctx and key in ctx._memo:
+        ctx._memo[key] = fn(ctx._memo[key])
+
+
+def forget(*keys):
+    ctx = _current.get()
+    if ctx:
+        for key in keys:
+            ctx._memo.pop(key, None)
+
+
+def deferred_batch(name: str, write):
+    """
+    Per-update dict that callers fill in; write(pipe, batch) runs once with
+    the other deferred writes. Returns None outside an update.
+    """
+    ctx = _current.get()
+    if ctx is None:
+        return None
+    batch = ctx._batches.get(name)
+    if batch is None:
+        batch = ctx._batches[name] = {}
+        ctx._deferred.append(lambda pipe: write(pipe, batch))
+    return batch
+
+
+def defer_write(write):
+    """Queue write(pipe) for the end of the update, or run it now outside one."""
+    ctx = _current.get()
+    if ctx:
+        ctx._deferred.append(write)
+        return
+    pipe = get_redis().pipeline(transaction=False)
+    write(pipe)
+    pipe.execute()